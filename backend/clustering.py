@@ -1,20 +1,66 @@
 from multiprocessing import Pool
 from matplotlib.cm import tab20
+import numpy as np
 import pandas as pd
+from tools.io import share_array, attach_array
 from tools.ml import pca_nd
 from tools.definitions import soundscape_sites
 from tools.plots import Plots
 
-def dimension_reduction(data:pd.DataFrame, band:str):
-    metrics = ['lppk', 'lprms', 'acorr3', 'B', 'D']
-    partial_data = data[metrics].dropna()
-    pca, _, _ = pca_nd(partial_data)
+cluster_metrics = ['lppk', 'lprms', 'acorr3', 'B', 'D']
+
+def dimension_reduction(data:pd.DataFrame, band:str, pca_backend="exact", dtype=None, rasterize=True, bins=512):
+    partial_data = data[cluster_metrics].dropna()
+    pca, _, _, _ = pca_nd(partial_data, backend=pca_backend, dtype=dtype)
     plot_data = [("PCA", pca)]
-    figs = colour_plots(data.loc[partial_data.index], band, plot_data)
+    figs = colour_plots(data.loc[partial_data.index], band, plot_data, rasterize, bins)
+
+    return band, figs[0]
+
+def share_band(data:pd.DataFrame, dtype=np.float64) -> tuple:
+    '''place the complete rows of a band's metric matrix and site codes in shared memory
+
+    data: minute-level data for the band
+    dtype: dtype of the shared metric matrix. np.float32 halves the shared memory
+
+    returns: (shared memory blocks to unlink when finished, descriptors for shared_dimension_reduction)
+    '''
+    partial_data = data[cluster_metrics].dropna()
+    sites = data.loc[partial_data.index, "soundtrap"].astype("category")
+    metric_shm, metric_descriptor = share_array(partial_data.to_numpy(dtype=dtype))
+    code_shm, code_descriptor = share_array(sites.cat.codes.to_numpy())
+    descriptors = {"metrics": metric_descriptor, "columns": cluster_metrics,
+                   "codes": code_descriptor, "sites": sites.cat.categories.tolist()}
+
+    return [metric_shm, code_shm], descriptors
+
+def shared_dimension_reduction(descriptors:dict, band:str, pca_backend="exact", rasterize=True, bins=512):
+    '''dimension_reduction for a worker process, reading the band from shared memory'''
+    metric_shm, metrics = attach_array(descriptors["metrics"])
+    code_shm, codes = attach_array(descriptors["codes"])
+    try:
+        pca, _, _, _ = pca_nd(metrics, backend=pca_backend)
+        sites = pd.DataFrame({"soundtrap": pd.Categorical.from_codes(codes.copy(), descriptors["sites"])})
+    finally:
+        del metrics, codes
+        metric_shm.close()
+        code_shm.close()
+
+    figs = colour_plots(sites, band, [("PCA", pca)], rasterize, bins)
 
     return band, figs[0]
 
-def colour_plots(data:pd.DataFrame, band:str, plot_data:list[tuple]):
+def colour_plots(data:pd.DataFrame, band:str, plot_data:list[tuple], rasterize=True, bins=512):
+    '''scatter plot the first two dimensions of each dataset, coloured by site
+
+    data: dataframe with a soundtrap column, one row per point
+    band: band name, used in the filenames
+    plot_data: [(plot name, array or dataframe of points)]
+    rasterize: draw points as a density image, see Plots.scatter_plot. False draws every marker
+    bins: image pixels along each axis when rasterizing
+
+    returns: list of figures
+    '''
     ret = []
     group_vals = data['soundtrap'].astype("category")
     cat_codes = group_vals.cat.codes
@@ -27,21 +73,36 @@ def colour_plots(data:pd.DataFrame, band:str, plot_data:list[tuple]):
 
         fig = Plots.scatter_plot(data_to_plot[:, 0], data_to_plot[:, 1],
             ("Dim 0", "Dim 1"), f"{band}_{plot_nam}",
-            "", color=colors, legend=unique_vals)
+            "", color=colors, legend=unique_vals, rasterize=rasterize, bins=bins)
         ret.append(fig)
 
     return ret
 
-def clustering(sscodes, n_processes):
+def clustering(sscodes, n_processes, pca_backend="exact", dtype=None, rasterize=True, bins=512):
+    '''reduce each band to two principal components and plot them coloured by site
+
+    sscodes: {band name: minute-level data}
+    n_processes: number of worker processes. 0 runs in this process
+    pca_backend: "exact", "randomized" or "incremental", see pca_nd
+    dtype: dtype to compute in, e.g. np.float32 to halve memory. defaults to float64, as the exact fit
+    rasterize, bins: see colour_plots
+    '''
     if n_processes:
-        with Pool(min(n_processes, len(sscodes))) as pool:
-            ret = [pool.apply_async(dimension_reduction,
-                                    args=(sscodes[name], name)) for name in sscodes]
-            res = [r.get() for r in ret]
+        shared = {name: share_band(data, dtype or np.float64) for name, data in sscodes.items()}
+        try:
+            with Pool(min(n_processes, len(sscodes))) as pool:
+                ret = [pool.apply_async(shared_dimension_reduction,
+                                        args=(descriptors, name, pca_backend, rasterize, bins)) for name, (_, descriptors) in shared.items()]
+                res = [r.get() for r in ret]
+        finally:
+            for blocks, _ in shared.values():
+                for block in blocks:
+                    block.close()
+                    block.unlink()
     else:
         res = []
         for name, data in sscodes.items():
-            fig = dimension_reduction(data, name)
+            fig = dimension_reduction(data, name, pca_backend, dtype, rasterize, bins)
             res.append(fig)
 
     return res
@@ -1,16 +1,21 @@
-import re
 from collections import Counter
+from multiprocessing import Pool
 from typing import Callable
 from functools import partial
 import pandas as pd
 import numpy as np
-from sklearn.preprocessing import scale
 from sklearn.metrics import f1_score
 from sklearn.tree import DecisionTreeClassifier, export_text
+from sklearn.tree._tree import TREE_LEAF
 from tools.definitions import partial_metrics, full_metrics, soundscape_sites, benthic_site_map
 from tools.ml import pca_nd
+from backend.habitat import get_habitat_pca
 from matplotlib.cm import tab20
 from tools.plots import Plots
+from tools.sketches import QuantileSketch
+
+n_diel_bins = 20
+percentiles = [0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95]
 
 def set_x_markers(scale:tuple, fig, ax, lgd=None) -> tuple:
     '''callback function for setting figure axes
@@ -30,134 +35,404 @@ def set_x_markers(scale:tuple, fig, ax, lgd=None) -> tuple:
 
     return fig, ax, lgd
 
-def plot_day_percentiles(site_data:pd.DataFrame, metrics:list, fltr:str, site:str, xcallback:Callable, scale:dict) -> None:
-    '''produce percentile plots of daily metrics, intended to be per-site
+def get_percentile_stats(data:pd.DataFrame, metrics:list, group_cols=('soundtrap', 'scaled_group')) -> pd.DataFrame:
+    '''percentiles and mean of each metric for every group in a single grouped pass
 
-    site_data: the dataframe for the site
+    data: minute-level data
+    metrics: which metrics to summarise
+    group_cols: columns to group by, per-site diel bins by default
+
+    returns: dataframe indexed by group_cols with (metric, statistic) columns, where statistics are each percentile and "Mean"
+    '''
+    groups = data[metrics].astype(float).groupby([data[col] for col in group_cols])
+    quantiles = groups.quantile(percentiles).unstack()
+    means = groups.mean()
+    means.columns = pd.MultiIndex.from_product([means.columns, ["Mean"]])
+    columns = pd.MultiIndex.from_product([metrics, percentiles + ["Mean"]])
+
+    return pd.concat([quantiles, means], axis=1).reindex(columns=columns)
+
+def get_site_percentiles(data:pd.DataFrame) -> pd.DataFrame:
+    '''percentile statistics for all sites and metrics, with D summarised on complete rows only'''
+    stats = get_percentile_stats(data, partial_metrics)
+    d_stats = get_percentile_stats(data.dropna(), ['D'])
+
+    return pd.concat([stats, d_stats], axis=1)
+
+def get_percentile_range(stats:pd.DataFrame, metric:str) -> pd.Series:
+    '''spread between the 95th and 5th percentiles, measured from the mean'''
+    mean = stats[(metric, "Mean")]
+    return (stats[(metric, 0.95)] - mean) - (stats[(metric, 0.05)] - mean)
+
+def plot_percentile_stats(site_stats:pd.DataFrame, metrics:list, fltr:str, site:str, xcallback:Callable, scale:dict, queue=None) -> None:
+    '''plot precomputed percentile statistics for a single site
+
+    site_stats: output of get_percentile_stats for one site, indexed by scaled_group
     metrics: which metrics to produce plots for
     fltr: the name of the filter band
     site: the name of the site
     xcallback: callback function to pass to the plotting function
     scale: dictionary of maximum values for each metric, can be used for scaling across multiple plots
+    queue: optional RenderQueue to draw the plots in the background
     '''
-    grouping_var = 'scaled_group'
-    site_data = site_data.sort_values(grouping_var)
-    group = site_data.groupby(grouping_var)
-    ret = {}
+    stat_names = percentiles + ["Mean"]
+    line_labels = [f"{100 * float(x)}%" for x in percentiles] + ["Mean"]
     for metric in metrics:
         callback = partial(xcallback, scale[metric])
-        metric_results = {0.05: None, 0.1: None, 0.25: None, 0.5: None, 0.75: None, 0.9: None, 0.95: None, "Mean": None}
-        for quant in [x for x in metric_results if isinstance(x, float)]:
-            q = group[metric].quantile(quant)
-            vals = q.values.tolist()
-            metric_results[quant] = vals
+        metric_stats = site_stats[metric].dropna(how='all')
+        x = metric_stats.index.tolist()
+        ys = [metric_stats[stat].tolist() for stat in stat_names]
+        Plots.dispatch("multiline_scatter_plot", queue, x=x, ys=ys, labels=("Hours from closest transition", metric),
+            line_labels=line_labels, output_path=f"{fltr}_{metric}_{site}", title="", callback=callback, legend_title="Percentiles")
 
-        mn = group[metric].mean().values.tolist()
-        metric_results["Mean"] = mn
+def plot_day_percentiles(site_data:pd.DataFrame, metrics:list, fltr:str, site:str, xcallback:Callable, scale:dict, queue=None) -> dict:
+    '''produce percentile plots of daily metrics, intended to be per-site
+
+    site_data: the dataframe for the site
+    metrics: which metrics to produce plots for
+    fltr: the name of the filter band
+    site: the name of the site
+    xcallback: callback function to pass to the plotting function
+    scale: dictionary of maximum values for each metric, can be used for scaling across multiple plots
+    queue: optional RenderQueue to draw the plots in the background
 
-        x = sorted(site_data[grouping_var].unique())
-        percentiles = []
-        for key in metric_results.keys():
-            try:
-                ans = f"{100 * float(key)}%"
-                percentiles.append(ans)
-            except ValueError:
-                percentiles.append("Mean")
+    returns: {metric: (mean, percentile range)} for each diel bin
+    '''
+    stats = get_percentile_stats(site_data, metrics, group_cols=['scaled_group'])
+    plot_percentile_stats(stats, metrics, fltr, site, xcallback, scale, queue)
 
+    return {metric: (stats[(metric, "Mean")].reset_index(drop=True), get_percentile_range(stats, metric).reset_index(drop=True))
+            for metric in metrics}
 
-        Plots.multiline_scatter_plot(x, list(metric_results.values()), ("Hours from closest transition", metric),
-            percentiles, f"{fltr}_{metric}_{site}", "", callback=callback, legend_title="Percentiles")
+def get_between_within(stats:pd.DataFrame, metrics=full_metrics) -> dict:
+    '''proportion of the range of within-site percentile ranges to the range of site means, for each diel bin
 
-        rng = (pd.Series(metric_results[0.95]) - pd.Series(metric_results["Mean"])) - (pd.Series(metric_results[0.05]) - pd.Series(metric_results["Mean"]))
-        ret[metric] = (pd.Series(metric_results["Mean"]), rng)
+    stats: output of get_percentile_stats over all sites
+    metrics: which metrics to compare
 
-    return ret
+    returns: {metric: proportion for each diel bin}
+    '''
+    proportions = {}
+    for metric in metrics:
+        means = stats[(metric, "Mean")].unstack('soundtrap')
+        mean_range = means.max(axis=1) - means.min(axis=1)
+        ranges = get_percentile_range(stats, metric).unstack('soundtrap')
+        mean_of_ranges = ranges.max(axis=1) - ranges.min(axis=1)
+        proportions[metric] = mean_of_ranges / mean_range
 
+    return proportions
 
-def get_habitat_cover() -> pd.DataFrame:
-    '''loads the habitat data from file
 
-    returns: dataframe with habitat information
+class DielSketches:
+    '''streaming replacement for get_percentile_stats, holding one quantile sketch per
+    (band, site, scaled_group, metric) instead of the raw minute rows
     '''
-    col = "point_human_group_code"
-    raw_benthic = pd.read_excel('data/benthic_wcp.xlsx')
-    groups = raw_benthic.groupby(['site_name', 'survey_title'])
-    df = groups[col].value_counts(normalize=True).reset_index()
-    date_map = {"Feb": "02", "Nov": "11", "Oct": "10", "Tiles": '02', 'Hydrophone': '10', 'February': "02", "October": "10", "November": "11"}
-    df["month"] = df["survey_title"].apply(lambda x: date_map[x.split(' ')[0]])
-    df = df.pivot_table('proportion', ['site_name', 'month'], col).reset_index().fillna(0)
-    df = df[df["month"] == "02"]
-    habitat_cols = df.drop(['site_name', 'month'], axis=1)
-    habitat_pca, weights, variance, _ = pca_nd(habitat_cols, 1)
-    weights = pd.DataFrame(weights, columns=habitat_cols.columns)
-    weights.to_csv("output/habitat_pca_weights.csv")
-    print(f"Habitat PCA explained variance: {variance}")
-    habitat = pd.Series(habitat_pca.squeeze())
-    habitat.index = df["site_name"].apply(lambda x: benthic_site_map[x])
-    habitat.name = "habitat_pca"
-
-    return habitat
+    def __init__(self, k:int=200, seed=None):
+        '''k: sketch accuracy parameter, see QuantileSketch.rank_error
+        seed: seed for the compaction offsets of every sketch
+        '''
+        self.k = k
+        self.rng = np.random.default_rng(seed)
+        self.sketches = {}
+
+    def _new_sketch(self) -> QuantileSketch:
+        return QuantileSketch(self.k, seed=self.rng.integers(2 ** 32))
+
+    def update(self, band:str, data:pd.DataFrame, metrics=full_metrics) -> "DielSketches":
+        '''add a batch of minute-level data for a band
+
+        band: name of the filter band
+        data: minute-level data with soundtrap and scaled_group columns
+        metrics: which metrics to sketch
+        '''
+        values = data[metrics].astype(float)
+        for (site, group), group_data in values.groupby([data['soundtrap'], data['scaled_group']]):
+            for metric in metrics:
+                key = (band, site, group, metric)
+                if key not in self.sketches:
+                    self.sketches[key] = self._new_sketch()
+
+                self.sketches[key].update(group_data[metric].to_numpy())
+
+        return self
+
+    def merge(self, other:"DielSketches") -> "DielSketches":
+        '''fold in sketches built on another partition of the data. other is left unchanged'''
+        if other.k != self.k:
+            raise ValueError(f"Cannot merge sketches with different k ({self.k} and {other.k})")
+
+        for key, sketch in other.sketches.items():
+            if key not in self.sketches:
+                self.sketches[key] = self._new_sketch() # copy rather than share the other partition's sketch
+
+            self.sketches[key].merge(sketch)
+
+        return self
+
+    def percentiles(self, band:str, metrics=full_metrics) -> pd.DataFrame:
+        '''estimated percentiles and exact means for a band, in the same format as get_percentile_stats
+
+        band: name of the filter band
+        metrics: which metrics to include
+        '''
+        rows = {}
+        for (key_band, site, group, metric), sketch in self.sketches.items():
+            if key_band != band or metric not in metrics:
+                continue
 
-def get_daily_metrics(data, metrics):
+            row = rows.setdefault((site, group), {})
+            for q, value in zip(percentiles, sketch.quantile(percentiles)):
+                row[(metric, q)] = value
+
+            row[(metric, "Mean")] = sketch.mean()
+
+        stats = pd.DataFrame.from_dict(rows, orient='index').sort_index()
+        stats.index.names = ['soundtrap', 'scaled_group']
+        columns = pd.MultiIndex.from_product([metrics, percentiles + ["Mean"]])
+
+        return stats.reindex(columns=columns)
+
+def get_habitat_cover() -> pd.Series:
+    '''loads the habitat PCA values, parsing the benthic data only when it has changed
+
+    returns: series of habitat PCA values indexed by site name
     '''
+    return get_habitat_pca()
+
+def aggregate_daily_medians(data:pd.DataFrame, metrics:list) -> pd.DataFrame:
+    '''median of every metric for each (day, soundtrap, scaled_group) in a single grouped pass
+
+    data: minute-level data with datetime, soundtrap and scaled_group columns
+    metrics: which metrics to aggregate
+
+    returns: dataframe indexed by (day, soundtrap, scaled_group) with the median and non-null count of each metric
     '''
-    data = data.copy()
-    daily_metrics = {metric: [] for metric in metrics}
-    labels = {metric: [] for metric in metrics}
-    data["day"] = data["datetime"].dt.floor('d')
-    days = data.groupby(['day', 'soundtrap'])
-    for day, day_data in days:
-        group = day_data.groupby('scaled_group')
-        for metric in metrics:
-            med = group[metric].quantile(0.5)
-            if len(med) != 20:
-                continue
-            day_results = med.sort_index().values.tolist()
-            daily_metrics[metric].append(day_results)
-            labels[metric].append(day_data['soundtrap'].unique()[0])
+    keys = [data["datetime"].dt.floor('D').rename("day"), data["soundtrap"], data["scaled_group"]]
+    groups = data[metrics].astype(float).groupby(keys)
+    medians = groups.median()
+    counts = groups.count().add_suffix("_n")
+
+    return pd.concat([medians, counts], axis=1)
+
+def get_daily_tensor(medians:pd.DataFrame, metrics:list, present:str=None) -> tuple:
+    '''arrange daily medians as a (days, metrics, diel bins) tensor, masking out days without every diel bin
 
-    cols = {metric: [f"{metric}_{x}" for x in range(20)] for metric in daily_metrics}
-    daily_metrics = {k: pd.DataFrame(v, columns=cols[k]) for k, v in daily_metrics.items()}
-    labels = {k: pd.Series(v) for k, v in labels.items()}
+    medians: output of aggregate_daily_medians
+    metrics: which metrics to include, in tensor order
+    present: only count diel bins where this metric has data. all aggregated bins are used if None
+
+    returns: (tensor, soundtrap label for each day, day for each day)
+    '''
+    if present is not None:
+        medians = medians[medians[f"{present}_n"] > 0]
+
+    day_levels = ["day", "soundtrap"]
+    bins_per_day = medians.groupby(level=day_levels).size()
+    day_keys = bins_per_day.index
+    rows = day_keys.get_indexer(medians.index.droplevel("scaled_group"))
+    positions = medians.groupby(level=day_levels).cumcount().to_numpy()
+    in_range = positions < n_diel_bins
+    tensor = np.full((len(day_keys), len(metrics), n_diel_bins), np.nan)
+    tensor[rows[in_range], :, positions[in_range]] = medians[metrics].to_numpy()[in_range]
+    complete = (bins_per_day == n_diel_bins).to_numpy()
+
+    return tensor[complete], day_keys.get_level_values("soundtrap")[complete], day_keys.get_level_values("day")[complete]
+
+def tensor_to_frames(tensor:np.ndarray, labels, metrics:list) -> tuple:
+    '''split a daily tensor into the per-metric dataframes and labels used for classification'''
+    cols = {metric: [f"{metric}_{x}" for x in range(n_diel_bins)] for metric in metrics}
+    daily_metrics = {metric: pd.DataFrame(tensor[:, i, :], columns=cols[metric]) for i, metric in enumerate(metrics)}
+    labels = {metric: pd.Series(labels) for metric in metrics}
 
     return daily_metrics, labels
 
+def get_daily_metrics(data, metrics):
+    '''daily diel vectors of the median of each metric in every scaled_group, for days with all diel bins
+
+    data: minute-level data
+    metrics: which metrics to produce vectors for
+
+    returns: ({metric: dataframe of daily vectors}, {metric: series of soundtrap labels})
+    '''
+    medians = aggregate_daily_medians(data, metrics)
+    tensor, labels, _ = get_daily_tensor(medians, metrics)
+
+    return tensor_to_frames(tensor, labels, metrics)
+
 def glmm_model(df, r_link, glmm, metric, band):
-    r_df = r_link.convert_to_rdf(df[[metric, "soundtrap", "scaled_group"]])
-    for col in ["soundtrap", "scaled_group"]:
-        r_link.change_col_to_factor(r_df, col)
+    r_df = r_link.convert_to_rdf(df[[metric, "soundtrap", "scaled_group"]], factors=["soundtrap", "scaled_group"])
 
     formula = f"{metric} ~ (1|soundtrap*scaled_group)"
     within_sd, between_sd = glmm.between_within_effects(r_df, f"{metric}_{band}", formula)
 
     return within_sd, between_sd
 
-def assess_df(df, labels, splitter, name):
-    split = splitter.split(df, labels)
-    for train_inds, test_inds in split:
-        tree = DecisionTreeClassifier(random_state=0)
-        tree.fit(df.iloc[train_inds], labels.iloc[train_inds])
-        preds = tree.predict(df.iloc[test_inds])
-        results = pd.DataFrame([labels.iloc[test_inds].values, preds]).transpose()
-        results.columns = ["actual", "predicted"]
-        f1s = [f1_score(results['actual'], results['predicted'], average=metric) for metric in ['micro', 'macro', 'weighted']]
-        truth = results.apply(lambda x: x["actual"] == x["predicted"], axis=1)
-        acc = truth.sum() / len(truth)
-        f1s.append(acc)
-
-        rules = export_text(tree, feature_names=df.columns)
-        formatted_rules = rules.split('\n')
-        n_rules = len(formatted_rules)
-        rules_export = re.findall(r"---\s(.+)\s[><=].*\n", rules)
-        rule_locations = set(rules_export)
-        n_rule_locations = len(rule_locations)
-        index_use = [x.split('_')[0] for x in rules_export]
-        index_counts = Counter(index_use)
-        time_use = [x.split('_')[1] for x in rules_export]
-        time_counts = Counter(time_use)
-        write_rules(rules, name)
-
-        return f1s, (name, n_rules, n_rule_locations), index_counts, time_counts
+def variance_components(data, metrics, site_col="soundtrap", group_col="scaled_group") -> pd.DataFrame:
+    '''method of moments variance components for a crossed site x diel bin random effects design, for all metrics at
+    once. exact for balanced designs. unbalanced designs use the unweighted cell means analysis with the harmonic
+    mean cell size, which stays close to REML while cell sizes are similar
+
+    data: minute-level data. NaNs are ignored per metric
+    metrics: metrics to estimate components for
+    site_col: between-site factor
+    group_col: diel bin factor
+
+    returns: dataframe indexed by metric with the variance of the site, diel bin, interaction and residual effects,
+        the between (site) and within (residual) SDs, and the intraclass correlation of sites
+    '''
+    cells = data.groupby([site_col, group_col])[metrics].agg(["count", "mean", "var"])
+    shape = (cells.index.levels[0].size, cells.index.levels[1].size, len(metrics))
+    full_index = pd.MultiIndex.from_product(cells.index.levels)
+    cells = cells.reindex(full_index)
+    counts, means, variances = (cells.xs(stat, axis=1, level=1)[metrics].to_numpy(dtype=float).reshape(shape)
+                                for stat in ["count", "mean", "var"])
+    counts = np.nan_to_num(counts)
+    means[counts == 0] = np.nan
+    n_sites = (~np.isnan(means)).any(axis=1).sum(axis=0)
+    n_groups = (~np.isnan(means)).any(axis=0).sum(axis=0)
+
+    residual_df = np.clip(counts - 1, 0, None).sum(axis=(0, 1))
+    ms_residual = np.nansum(np.clip(counts - 1, 0, None) * np.nan_to_num(variances), axis=(0, 1)) / residual_df
+    n_cells = (counts > 0).sum(axis=(0, 1))
+    n_harmonic = n_cells / np.where(counts > 0, 1 / np.where(counts > 0, counts, 1), 0).sum(axis=(0, 1))
+
+    grand = np.nanmean(means, axis=(0, 1))
+    site_means = np.nanmean(means, axis=1)
+    group_means = np.nanmean(means, axis=0)
+    interaction = means - site_means[:, None, :] - group_means[None, :, :] + grand
+    ms_site = n_harmonic * n_groups * np.nansum((site_means - grand) ** 2, axis=0) / (n_sites - 1)
+    ms_group = n_harmonic * n_sites * np.nansum((group_means - grand) ** 2, axis=0) / (n_groups - 1)
+    ms_interaction = n_harmonic * np.nansum(interaction ** 2, axis=(0, 1)) / ((n_sites - 1) * (n_groups - 1))
+
+    components = pd.DataFrame({
+        site_col: np.clip((ms_site - ms_interaction) / (n_harmonic * n_groups), 0, None),
+        group_col: np.clip((ms_group - ms_interaction) / (n_harmonic * n_sites), 0, None),
+        "interaction": np.clip((ms_interaction - ms_residual) / n_harmonic, 0, None),
+        "residual": ms_residual,
+    }, index=pd.Index(metrics, name="metric"))
+    components["between_sd"] = np.sqrt(components[site_col])
+    components["within_sd"] = np.sqrt(components["residual"])
+    components["icc"] = components[site_col] / components[[site_col, group_col, "interaction", "residual"]].sum(axis=1)
+
+    return components
+
+def screen_between_within(sscodes, bands, metrics=full_metrics, min_icc=0.05) -> pd.DataFrame:
+    '''estimate between and within site SDs for every band and metric, flagging those worth confirming in R
+
+    sscodes: minute-level data for each band
+    bands: bands to screen
+    metrics: metrics to screen
+    min_icc: smallest share of variance explained by sites for a metric to be a candidate
+
+    returns: variance_components output indexed by (band, metric), with a candidate column
+    '''
+    screened = pd.concat({band: variance_components(sscodes[band], metrics) for band in bands}, names=["band"])
+    screened["candidate"] = screened["icc"] >= min_icc
+
+    return screened
+
+def confirm_candidates(sscodes, screened, r_link, glmm) -> pd.DataFrame:
+    '''fit the R mixed model only for the band and metric combinations that passed screening
+
+    sscodes: minute-level data for each band
+    screened: output of screen_between_within
+    r_link: rPlotter used to transfer the data
+    glmm: loaded glmm.R source
+
+    returns: within and between SDs from R, indexed by (band, metric)
+    '''
+    confirmed = {(band, metric): glmm_model(sscodes[band], r_link, glmm, metric, band)
+                 for band, metric in screened.index[screened["candidate"]]}
+
+    return pd.DataFrame.from_dict(confirmed, orient="index", columns=["within_sd", "between_sd"])
+
+def evaluate_fold(df, labels, train_inds, test_inds, export_rules=False) -> tuple:
+    '''fit and score a site classification tree on one cross-validation fold
+
+    df: daily diel vectors
+    labels: site label for each row of df
+    train_inds: positional indices of the training rows
+    test_inds: positional indices of the test rows
+    export_rules: whether to also return a text export of the tree
+
+    returns: ([F1 micro, F1 macro, F1 weighted, accuracy], tree_rule_stats output, text rules or None)
+    '''
+    tree = DecisionTreeClassifier(random_state=0)
+    tree.fit(df.iloc[train_inds], labels.iloc[train_inds])
+    preds = tree.predict(df.iloc[test_inds])
+    actual = labels.iloc[test_inds].values
+    f1s = [f1_score(actual, preds, average=metric) for metric in ['micro', 'macro', 'weighted']]
+    f1s.append((actual == preds).sum() / len(actual))
+    rules = export_text(tree, feature_names=list(df.columns), max_depth=tree.get_depth()) if export_rules else None
+
+    return f1s, tree_rule_stats(tree, df.columns), rules
+
+def tree_rule_stats(tree:DecisionTreeClassifier, feature_names) -> tuple:
+    '''rule and feature use statistics, read from the node arrays of a fitted tree
+
+    tree: fitted tree
+    feature_names: names of the training columns, formatted as "{metric}_{diel bin}"
+
+    returns: (number of rules (leaves), distinct split features, metric split counts, diel bin split counts, rule depth)
+    '''
+    nodes = tree.tree_
+    is_split = nodes.children_left != TREE_LEAF
+    split_features = np.asarray(feature_names)[nodes.feature[is_split]]
+    index_counts = Counter(x.split('_')[0] for x in split_features)
+    time_counts = Counter(x.split('_')[1] for x in split_features)
+
+    return int((~is_split).sum()), len(set(split_features)), index_counts, time_counts, int(nodes.max_depth)
+
+def combine_folds(name:str, fold_results:list) -> tuple:
+    '''aggregate the fold results for a dataset, writing its rules if they were exported
+
+    name: dataset name, as "{band}_{metric}"
+    fold_results: list of evaluate_fold outputs
+
+    returns: (mean [F1 micro, F1 macro, F1 weighted, accuracy], (name, mean rules, mean rule locations, mean depth),
+              mean metric split counts, mean diel bin split counts). counts are averaged over folds, keeping the
+              scale of a single fitted tree
+    '''
+    f1s = np.mean([x[0] for x in fold_results], axis=0).tolist()
+    stats = [x[1] for x in fold_results]
+    n_rules, n_rule_locations, depth = (np.mean([x[i] for x in stats]) for i in (0, 1, 4))
+    index_counts = Counter({k: v / len(stats) for k, v in sum((x[2] for x in stats), Counter()).items()})
+    time_counts = Counter({k: v / len(stats) for k, v in sum((x[3] for x in stats), Counter()).items()})
+    rules = [x[2] for x in fold_results]
+    if any(x is not None for x in rules):
+        write_rules('\n'.join(f"Fold {i}\n{x}" for i, x in enumerate(rules)), name)
+
+    return f1s, (name, n_rules, n_rule_locations, depth), index_counts, time_counts
+
+def assess_df(df, labels, splitter, name, export_rules=False):
+    '''cross-validate site classification on one dataset, averaging over every fold of the splitter'''
+    folds = [evaluate_fold(df, labels, train_inds, test_inds, export_rules) for train_inds, test_inds in splitter.split(df, labels)]
+
+    return combine_folds(name, folds)
+
+def assess_datasets(datasets:dict, splitter, n_processes=None, write_counts=True, export_rules=False) -> dict:
+    '''cross-validate every fold of every dataset concurrently
+
+    datasets: {name: (daily diel vectors, site labels)}
+    splitter: sklearn cross-validation splitter
+    n_processes: number of worker processes, defaults to the number of cores
+    write_counts: whether to write the rule counts and metric/diel bin use for all datasets
+    export_rules: whether to write a text export of each dataset's trees
+
+    returns: {name: assess_df output}
+    '''
+    with Pool(n_processes) as pool:
+        pending = {name: [pool.apply_async(evaluate_fold, args=(df, labels, train_inds, test_inds, export_rules))
+                          for train_inds, test_inds in splitter.split(df, labels)]
+                   for name, (df, labels) in datasets.items()}
+        results = {name: combine_folds(name, [r.get() for r in folds]) for name, folds in pending.items()}
+
+    if write_counts:
+        write_rule_counts([x[1] for x in results.values()])
+        write_metric_rule_counts("index", [(name, x[2]) for name, x in results.items()])
+        write_metric_rule_counts("time", [(name, x[3]) for name, x in results.items()])
+
+    return results
 
 def write_rules(rules, name):
     path = f"output/rules_{name}.txt"
@@ -167,32 +442,22 @@ def write_rules(rules, name):
 def normalise(minimum, maximum, x):
     return 2 * (x - minimum)/(maximum-minimum) - 1
 
-def get_centroid(arr):
-    length = arr.shape[0]
-    sum_x = np.sum(arr[:, 0])
-    sum_y = np.sum(arr[:, 1])
-
-    return sum_x/length, sum_y/length
-
-def get_pca_centroids(pca, data, labels):
-    scaled_data = pd.DataFrame(scale(data))
-    df = pd.concat([scaled_data, labels], axis=1)
-    col_list = df.columns.to_list()
-    col_list[-1] = "labels"
-    df.columns = col_list
-    groups = df.groupby("labels")
-    centroids = {}
-    for group, group_data in groups:
-        points = pca.transform(group_data.drop('labels', axis=1))
-        centroid = get_centroid(points)
-        centroids[soundscape_sites[group]] = centroid
-
-    centroids = pd.Series(centroids, name="centroids")
-    centroids = pd.DataFrame(centroids.to_list(), index=centroids.index, columns=["x", "y"])
+def get_pca_centroids(points:pd.DataFrame, labels:pd.Series) -> pd.DataFrame:
+    '''centroid of each site in PCA space, as the mean of its projected points
+
+    points: projected points from pca_nd, with the first two components in the first two columns
+    labels: soundtrap label for each point, in the same order
+
+    returns: dataframe of x, y centroids indexed by site name
+    '''
+    centroids = points.iloc[:, :2].groupby(labels.values).mean()
+    centroids.index = [soundscape_sites[x] for x in centroids.index]
+    centroids.columns = ["x", "y"]
+
     return centroids
 
-def pca_plot(data, labels, name, color_by_site=True):
-    pca, weights, variance, model = pca_nd(data, 2)
+def pca_plot(data, labels, name, color_by_site=True, queue=None, rasterize=False):
+    pca, weights, variance, _ = pca_nd(data, 2)
     print(f"Variance for {name}: {variance}")
     pca = pd.DataFrame(pca)
     pca_out= pd.concat([pca, labels], axis=1)
@@ -204,7 +469,7 @@ def pca_plot(data, labels, name, color_by_site=True):
     group_vals = labels.astype("category")
     cat_codes = group_vals.cat.codes
     nunique = group_vals.nunique()
-    centroids = get_pca_centroids(model, data, labels)
+    centroids = get_pca_centroids(pca, labels)
     centroids.to_csv(f"output/centroids_{name}.csv", index_label="site")
     if color_by_site:
         colors = pd.Series([tab20(float(x)/nunique) for x in cat_codes])
@@ -221,18 +486,19 @@ def pca_plot(data, labels, name, color_by_site=True):
         cbars.append(tuple([habitat, examples, "Habitat PCA value"]))
 
     full_labels = [soundscape_sites[x] for x in labels]
-    fig = Plots.scatter_plot(pca[0], pca[1], ("PCA Dim 0", "PCA Dim 1"), f"pca_{name}", legend=full_labels, color=colors, colbar=cbars)
+    fig = Plots.dispatch("scatter_plot", queue, x=pca[0], y=pca[1], labels=("PCA Dim 0", "PCA Dim 1"), output_path=f"pca_{name}",
+                         legend=full_labels, color=colors, colbar=cbars, rasterize=rasterize)
 
     return fig
 
 def write_rule_counts(rules):
     fname = f"output/n_rules.csv"
     with open(fname, 'w+') as f:
-        cols = 'Dataset,Band,Metric,Rules,Locations\n'
+        cols = 'Dataset,Band,Metric,Rules,Locations,Depth\n'
         f.write(cols)
-        for name, n_rules, n_locations in rules:
+        for name, n_rules, n_locations, depth in rules:
             formatted_name = name.replace('_', ',')
-            ln = f"{formatted_name},{n_rules},{n_locations}\n"
+            ln = f"{formatted_name},{n_rules},{n_locations},{depth}\n"
             f.write(ln)
 
 def write_metric_rule_counts(typ, counts):
@@ -247,33 +513,26 @@ def write_metric_rule_counts(typ, counts):
             ln = f"{model},{formatted_vals}\n"
             f.write(ln)
 
-def get_site_metrics(data, fltr, x_callback, axis_ranges):
-    site_results = {}
-    for site, site_data in data.groupby('soundtrap'):
-        results = plot_day_percentiles(site_data, partial_metrics, fltr, site, x_callback, axis_ranges)
-        par_data = site_data.dropna()
-        d_results = plot_day_percentiles(par_data, ['D'], fltr, site, x_callback, axis_ranges)
-        results['D'] = d_results['D']
-        site_results[site] = results
-
-    for metric in full_metrics:
-        means = [x[metric][0] for x in site_results.values()]
-        means_df = pd.concat(means, axis=1)
-        mean_range = means_df.apply(lambda x: x.max() - x.min(), axis=1)
-        ranges = [x[metric][1] for x in site_results.values()]
-        ranges_df = pd.concat(ranges, axis=1)
-        mean_of_ranges = ranges_df.apply(lambda x: x.max() - x.min(), axis=1)
-
-        proportion = mean_of_ranges / mean_range
-        proportion.to_csv(f"output/between_within_{fltr}_{metric}.csv")
+def get_site_metrics(data, fltr, x_callback, axis_ranges, render=True, queue=None):
+    stats = get_site_percentiles(data)
+    if render:
+        for site, site_stats in stats.groupby(level='soundtrap'):
+            plot_percentile_stats(site_stats.droplevel('soundtrap'), full_metrics, fltr, site, x_callback, axis_ranges, queue)
 
+    proportions = get_between_within(stats)
+    for metric, proportion in proportions.items():
+        proportion.to_csv(f"output/between_within_{fltr}_{metric}.csv")
         print(f"Proportion of mean of ranges to range of means for {metric}:\n{proportion}")
 
+    return proportions
+
 
 def get_dailies_for_all_metrics(data):
-    daily_metrics, labels = get_daily_metrics(data, partial_metrics)
-    partial_data = data[~data['D'].isna()]
-    d_metrics, d_labels = get_daily_metrics(partial_data, ['D'])
+    medians = aggregate_daily_medians(data, full_metrics)
+    tensor, partial_labels, _ = get_daily_tensor(medians, partial_metrics)
+    daily_metrics, labels = tensor_to_frames(tensor, partial_labels, partial_metrics)
+    d_tensor, d_partial_labels, _ = get_daily_tensor(medians, ['D'], present='D') # D has fewer points than the others
+    d_metrics, d_labels = tensor_to_frames(d_tensor, d_partial_labels, ['D'])
     daily_metrics['D'] = d_metrics['D']
     labels['D'] = d_labels['D']
 
@@ -1,21 +1,77 @@
+import numpy as np
+import pandas as pd
 from tools.plots import Plots
 from tools.definitions import soundscape_sites, full_metrics
 
-def create_boxplots(fltr, data):
+def get_box_stats(data, metric, group_col="soundtrap", whis=1.5) -> list:
+    '''quartiles, whiskers and outliers for every group from one sort per group, computed as matplotlib's boxplot does
+
+    data: dataframe with the metric and group columns
+    metric: column to summarise. NaNs are ignored
+    group_col: column to group by, one box per group
+    whis: whisker reach as a multiple of the interquartile range
+
+    returns: list of dicts for matplotlib's bxp, one per group in sorted order, labelled with the group value
+    '''
+    values = data[metric].to_numpy(dtype=float)
+    codes, groups = pd.factorize(data[group_col], sort=True)
+    keep = ~np.isnan(values) & (codes >= 0) # factorize codes missing group keys as -1, groupby drops them
+    values, codes = values[keep], codes[keep]
+    values = values[np.argsort(codes, kind='stable')]
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(groups)))])
+
+    stats = []
+    for group, start, end in zip(groups, bounds[:-1], bounds[1:]):
+        unsorted = values[start:end]
+        x = np.sort(unsorted)
+        if not len(x):
+            continue
+
+        positions = (len(x) - 1) * np.array([0.25, 0.5, 0.75]) # linear interpolation, as np.percentile
+        below = np.floor(positions).astype(int)
+        above = np.minimum(below + 1, len(x) - 1)
+        q1, med, q3 = x[below] + (x[above] - x[below]) * (positions - below)
+        iqr = q3 - q1
+        first = np.searchsorted(x, q1 - whis * iqr, side='left')
+        last = np.searchsorted(x, q3 + whis * iqr, side='right')
+        whislo = min(x[first], q1) if first < len(x) else q1 # as matplotlib, whiskers never sit inside the box
+        whishi = max(x[last - 1], q3) if last > 0 else q3
+        fliers = np.concatenate([unsorted[unsorted < whislo], unsorted[unsorted > whishi]]) # in data order, as matplotlib draws them
+        stats.append({"label": group, "q1": q1, "med": med, "q3": q3, "iqr": iqr, "whislo": whislo, "whishi": whishi,
+                      "mean": x.mean(), "fliers": fliers})
+
+    return stats
+
+def get_histogram_counts(values, n_bins="unique_values") -> tuple:
+    '''histogram counts, binned as matplotlib's hist would bin the raw values
+
+    values: vector/series of values. NaNs are ignored
+    n_bins: number of bins. if n_bins == "unique_values", one bin per distinct value
+
+    returns: (counts, bin edges)
+    '''
+    values = np.asarray(values, dtype=float)
+    values = values[~np.isnan(values)]
+    if n_bins == "unique_values":
+        n_bins = len(np.unique(values))
+
+    return np.histogram(values, n_bins)
+
+def create_boxplots(fltr, data, queue=None):
     figs = []
     for metric in full_metrics:
         use_data = data
         if metric in ["Dt", "Ds", "D"]:
             use_data = data.dropna(subset=metric)
 
-        Plots.basic_histogram(use_data[metric], f"histogram_{fltr}_{metric}", 10)
-        site_plot_data = []
-        labels = []
-        for site, site_data in use_data.groupby("soundtrap"):
-            labels.append(soundscape_sites[site])
-            site_plot_data.append(site_data[metric].dropna())
+        counts, edges = get_histogram_counts(use_data[metric], n_bins=10)
+        Plots.dispatch("histogram_from_counts", queue, counts=counts, edges=edges, filename=f"histogram_{fltr}_{metric}")
+        stats = get_box_stats(use_data, metric)
+        for site_stats in stats:
+            site_stats["label"] = soundscape_sites[site_stats["label"]]
 
-        fig = Plots.create_boxplot_group(site_plot_data, labels, "", f"box_{fltr}_{metric}", ("Site", metric))
+        fig = Plots.dispatch("boxplot_group_from_stats", queue, stats=stats, title="",
+                             filename=f"box_{fltr}_{metric}", axis_labels=("Site", metric))
         figs.append((metric, fig))
 
     return figs
@@ -1,3 +1,8 @@
+import hashlib
+from multiprocessing import get_context
+from multiprocessing.connection import wait
+from pathlib import Path
+import pandas as pd
 from tools.definitions import full_metrics
 from rpy2.rinterface_lib.embedded import RRuntimeError
 
@@ -20,25 +25,223 @@ required_cols = full_metrics + continuous + factors + circular + re
 data_types = {x: float for x in full_metrics + continuous + circular}
 predictors = continuous + circular
 
-def create_gams(r_link, name, sscodes):
-    data = sscodes[name]
+def prepare_gam_data(data):
+    '''cast, normalise and drop incomplete rows from a band's data, ready for the GAM model sets
+
+    data: minute-level data for one band. left unchanged
+
+    returns: copy of the required columns with complete rows
+    '''
+    data = data[required_cols].copy()
     for col, typ in data_types.items():
         data[col] = data[col].astype(typ)
 
     for col in ["lprms", "lppk"]: # can't GAM with negative values in tweedie family.
         data[col] = normalise(data[col])
 
-    data = data[required_cols].dropna()
-    rdf = r_link.convert_to_rdf(data)
-    r_link.change_col_to_factor(rdf, 'soundtrap')
+    return data.dropna()
+
+def create_gams(r_link, name, sscodes):
+    data = prepare_gam_data(sscodes[name])
+    rdf = r_link.convert_to_rdf(data, factors=['soundtrap'])
 
     path = f"output/rdf_{name}.rda"
     r_link.r_src.save_object(rdf, str(path))
+    data_hash = r_link.data_digest(rdf) if r_link.use_cache else None
     for metric in full_metrics:
         extra_preds = predictors
         try:
-            r_link.fss_gam(rdf, metric, extra_preds, factors, circular, re, f"{name}_{metric}")
+            r_link.fss_gam(rdf, metric, extra_preds, factors, circular, re, f"{name}_{metric}", data_hash=data_hash)
         except RRuntimeError as e:
             print("Runtime error")
             print(e)
             continue
+
+def stratified_sample(data, fraction, n_day_bins=20, seed=0):
+    '''subsample rows evenly across soundtraps and times of day, keeping the same proportion of every stratum
+
+    data: minute-level data with soundtrap and scaled_day columns
+    fraction: proportion of rows to keep from each soundtrap x scaled_day bin
+    n_day_bins: number of equal width scaled_day bins
+    seed: random seed
+    '''
+    day_bins = pd.cut(data["scaled_day"], n_day_bins, labels=False)
+
+    return data.groupby([data["soundtrap"], day_bins], observed=True).sample(frac=fraction, random_state=seed).sort_index()
+
+def fit_model_set(data_path, band, metric, output_path="output", r_parallel=False, invalidate=False, suffix="", data_hash=None,
+                  **gam_options):
+    '''fit one FSSgam model set in a fresh embedded R session. runs in a worker process
+
+    data_path: feather file of the prepared band data, read in python and converted to R as in create_gams
+    band: frequency band name
+    metric: response metric
+    output_path: folder for the model set outputs
+    r_parallel: let FSSgam fit candidate models on multiple cores within this worker
+    invalidate: refit even if an identical model set is cached
+    suffix: appended to the model set name, to keep the outputs of different settings apart
+    data_hash: content hash of the band data, shared by the model sets of a band
+    gam_options: engine and nthreads passed to GamLink.fss_gam
+
+    returns: (band, metric, error message or None)
+    '''
+    from tools.gams.gam_link import GamLink # each worker embeds its own R
+
+    r_link = GamLink()
+    r_link.output_path = output_path
+    r_link.cache_path = Path(output_path) / "gam_cache"
+    r_link.capture_rpy2_output()
+    try:
+        rdf = r_link.convert_to_rdf(pd.read_feather(data_path), factors=re)
+        r_link.fss_gam(rdf, metric, predictors, factors, circular, re, f"{band}_{metric}{suffix}",
+                       parallel=r_parallel, invalidate=invalidate, data_hash=data_hash, **gam_options)
+    except RRuntimeError as e:
+        return band, metric, str(e)
+
+    return band, metric, None
+
+def _report_model_set(sender, func, args, kwargs):
+    '''run func in a child process and send its result back. internal use only'''
+    try:
+        result = func(*args, **kwargs)
+    except Exception as e: # pylint: disable=broad-except
+        result = (args[1], args[2], repr(e))
+
+    sender.send(result)
+    sender.close()
+
+def run_isolated(func, jobs, n_processes) -> list:
+    '''run each job in its own freshly spawned process, at most n_processes at a time. a process that crashes or is
+    killed, e.g. by a segfault in R or the out of memory killer, is reported as a failure of its job only
+
+    func: function returning (band, metric, error message or None), as fit_model_set
+    jobs: list of (args, kwargs) for func. args start with (data_path, band, metric)
+    n_processes: number of processes running at once
+
+    returns: func's result for every job, in job order
+    '''
+    context = get_context("spawn") # embedded R cannot be forked safely
+    pending = list(enumerate(jobs))
+    running = {}
+    results = [None] * len(jobs)
+    while pending or running:
+        while pending and len(running) < n_processes:
+            i, (args, kwargs) = pending.pop(0)
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=_report_model_set, args=(sender, func, args, kwargs))
+            process.start()
+            sender.close()
+            running[process.sentinel] = (i, process, receiver)
+
+        for sentinel in wait(list(running)):
+            i, process, receiver = running.pop(sentinel)
+            process.join()
+            try:
+                results[i] = receiver.recv()
+            except EOFError: # exited without reporting
+                results[i] = (jobs[i][0][1], jobs[i][0][2], f"Worker exited with code {process.exitcode}")
+            finally:
+                receiver.close()
+
+    return results
+
+def run_gams(sscodes, bands, metrics=None, n_processes=4, output_path="output", r_parallel=False, invalidate=False,
+             engine="gam", nthreads=1, sample_fraction=None, suffix="") -> pd.DataFrame:
+    '''fit the (band, metric) model sets in separate worker processes. a failing model set, including one whose
+    worker crashes or runs out of memory, is reported without stopping the others
+
+    sscodes: minute-level data for each band
+    bands: bands to fit
+    metrics: metrics to fit for every band, defaults to all metrics
+    n_processes: number of model sets fitted at once. each holds its own copy of the band data and model fits in R,
+        so peak memory grows with n_processes
+    output_path: folder for the model set outputs
+    r_parallel: also let FSSgam use multiple cores inside each worker. multiplies the cores used by n_processes
+    invalidate: refit every model set instead of reusing cached results for unchanged data and code
+    engine: "gam", or "bam" to fit discretised big-data models
+    nthreads: threads used by each bam fit
+    sample_fraction: fit to a stratified sample of this proportion of each soundtrap x scaled_day bin instead of all rows
+    suffix: appended to the model set names, to keep the outputs of different settings apart
+
+    returns: dataframe with the band, metric and error message (None on success) of each model set
+    '''
+    metrics = full_metrics if metrics is None else metrics
+    input_path = Path(output_path) / "gam_inputs"
+    input_path.mkdir(parents=True, exist_ok=True)
+    data_paths, data_hashes = {}, {}
+    for band in bands:
+        data = prepare_gam_data(sscodes[band])
+        if sample_fraction is not None:
+            data = stratified_sample(data, sample_fraction)
+
+        data_paths[band] = input_path / f"{band}{suffix}.feather"
+        data.reset_index(drop=True).to_feather(data_paths[band])
+        data_hashes[band] = input_digest(band, suffix, output_path) # once per band, not per model set
+
+    jobs = [((data_paths[band], band, metric, output_path, r_parallel, invalidate, suffix),
+             {"data_hash": data_hashes[band], "engine": engine, "nthreads": nthreads})
+            for band in bands for metric in metrics]
+    results = pd.DataFrame(run_isolated(fit_model_set, jobs, n_processes), columns=["band", "metric", "error"])
+    for _, row in results.dropna(subset="error").iterrows():
+        print(f"Model set {row['band']} {row['metric']} failed")
+        print(row["error"])
+
+    return results
+
+def read_model_table(name, output_path="output") -> pd.DataFrame:
+    '''model selection table saved by a FSSgam model set, ordered by AICc'''
+    table = pd.read_csv(Path(output_path) / f"all.mod.fits_{name}_.csv", index_col=0)
+
+    return table.sort_values("AICc").reset_index(drop=True)
+
+def input_digest(band, suffix="", output_path="output"):
+    '''content hash of the data run_gams fitted a band's model sets to, or None if run_gams did not write it'''
+    path = Path(output_path) / "gam_inputs" / f"{band}{suffix}.feather"
+    if not path.is_file():
+        return None
+
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+def compare_model_sets(bands, suffix, reference_suffix="", metrics=None, output_path="output", top=5) -> pd.DataFrame:
+    '''compare the model selection of fits made with different settings (e.g. bam or subsampled data) to reference
+    fits of the full data, and save the comparison to file
+
+    bands: bands to compare
+    suffix: model set name suffix of the fits being checked
+    reference_suffix: model set name suffix of the reference fits
+    metrics: metrics to compare, defaults to all metrics
+    output_path: folder with the model set outputs
+    top: number of best models to compare
+
+    returns: dataframe with the best model of each fit, whether it agrees with the reference, the rank of the
+        reference's best model, the overlap of the top models, and the AICc difference of the selected model. AICc
+        values are only comparable between fits of the same rows, so the difference is NaN unless both fits are
+        known to use identical run_gams inputs, e.g. a bam fit of the full data against the gam reference
+    '''
+    metrics = full_metrics if metrics is None else metrics
+    rows = []
+    for band in bands:
+        digest = input_digest(band, suffix, output_path)
+        same_data = digest is not None and digest == input_digest(band, reference_suffix, output_path)
+        for metric in metrics:
+            name = f"{band}_{metric}"
+            try:
+                table = read_model_table(f"{name}{suffix}", output_path)
+                reference = read_model_table(f"{name}{reference_suffix}", output_path)
+            except FileNotFoundError:
+                continue
+
+            best, reference_best = table["modname"].iloc[0], reference["modname"].iloc[0]
+            ranks = table.index[table["modname"] == reference_best]
+            reference_aicc = reference.set_index("modname")["AICc"]
+            rows.append({"band": band, "metric": metric, "best_model": best, "reference_best_model": reference_best,
+                         "same_best": best == reference_best, "reference_best_rank": ranks[0] + 1 if len(ranks) else None,
+                         f"top_{top}_overlap": len(set(table["modname"][:top]) & set(reference["modname"][:top])),
+                         "best_AICc": table["AICc"].iloc[0], "reference_best_AICc": reference["AICc"].iloc[0],
+                         "same_data": same_data,
+                         "AICc_difference": table["AICc"].iloc[0] - reference_aicc.get(best, float("nan")) if same_data else float("nan")})
+
+    comparison = pd.DataFrame(rows)
+    comparison.to_csv(Path(output_path) / f"model_set_comparison{suffix}.csv", index=False)
+
+    return comparison
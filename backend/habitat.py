@@ -0,0 +1,115 @@
+'''benthic habitat survey data, parsed from the workbook once and served from memory'''
+from pathlib import Path
+import pandas as pd
+from numpy import log
+from tools.definitions import benthic_site_map
+from tools.ml import pca_nd
+
+benthic_path = Path("data/benthic_wcp.xlsx")
+cache_path = Path("data/benthic_wcp.pkl")
+habitat_col = "point_human_group_code"
+survey_months = {"Feb": "02", "Nov": "11", "Oct": "10", "Tiles": '02', 'Hydrophone': '10', 'February': "02", "October": "10", "November": "11"}
+_memory = {}
+
+def source_stamp(source=benthic_path) -> tuple:
+    '''modification time and size of the workbook, used to invalidate cached data'''
+    stat = Path(source).stat()
+    return (stat.st_mtime_ns, stat.st_size)
+
+def _memoised(name, build):
+    '''return a cached result for the current version of the workbook, building it if needed. internal use only'''
+    key = (name, source_stamp())
+    if key not in _memory:
+        _memory[key] = build()
+
+    return _memory[key].copy()
+
+def parse_benthic_data(source=benthic_path) -> pd.DataFrame:
+    '''read the workbook and find the proportion of survey points in each habitat group
+
+    returns: dataframe with site_name, survey_title, habitat group, proportion and survey month
+    '''
+    raw_benthic = pd.read_excel(source)
+    groups = raw_benthic.groupby(['site_name', 'survey_title'])
+    df = groups[habitat_col].value_counts(normalize=True).reset_index()
+    df["month"] = df["survey_title"].apply(lambda x: survey_months[x.split(' ')[0]])
+
+    return df
+
+def load_benthic_data() -> pd.DataFrame:
+    '''parsed benthic proportions, from the binary cache if it matches the current workbook'''
+    def build():
+        stamp = source_stamp()
+        if cache_path.is_file():
+            cached = pd.read_pickle(cache_path)
+            if cached["stamp"] == stamp:
+                return cached["data"]
+
+        data = parse_benthic_data()
+        pd.to_pickle({"stamp": stamp, "data": data}, cache_path)
+
+        return data
+
+    return _memoised("benthic", build)
+
+def get_habitat_proportions(month="02") -> pd.DataFrame:
+    '''proportion of each habitat group at each site for a survey month
+
+    month: survey month, as a two digit string
+
+    returns: dataframe indexed by benthic site name, with a column for every habitat group seen in any survey
+    '''
+    def build():
+        df = load_benthic_data()
+        pivoted = df.pivot_table('proportion', ['site_name', 'month'], habitat_col).reset_index().fillna(0)
+        pivoted = pivoted[pivoted["month"] == month]
+
+        return pivoted.drop('month', axis=1).set_index('site_name')
+
+    return _memoised(("proportions", month), build)
+
+def get_proportional_habitat_cover() -> pd.DataFrame:
+    '''loads the habitat data from file
+
+    returns: dataframe with habitat information
+    '''
+    def build():
+        merge = ["A", "AB", "OT", "SC", "SP"]
+        habitat_cols = get_habitat_proportions()
+        habitat_cols = habitat_cols.loc[:, (habitat_cols != 0).any()] # only the groups surveyed in February
+        habitat_cols.index = habitat_cols.index.map(lambda x: benthic_site_map[x])
+        habitat_cols["O"] = habitat_cols[merge].sum(axis=1)
+
+        return habitat_cols.drop(merge, axis=1).map(lambda x: 1e-5 if not x else x)
+
+    return _memoised("proportional", build)
+
+def get_habitat_log_ratios(): # this is not generalisable because dataset knowledge is used
+    def build():
+        habitat_data = get_proportional_habitat_cover()
+        baseline_col = 'O'
+        hab_cols = habitat_data.columns.drop(baseline_col)
+        ratios = habitat_data[hab_cols].div(habitat_data[baseline_col], axis=0)
+
+        return ratios.map(lambda x: log(x))
+
+    return _memoised("log_ratios", build)
+
+def get_habitat_pca() -> pd.Series:
+    '''first principal component of the habitat proportions at each site
+
+    returns: series of habitat PCA values indexed by site name
+    '''
+    def build():
+        habitat_cols = get_habitat_proportions()
+        habitat_pca, weights, variance, _ = pca_nd(habitat_cols, 1)
+        weights = pd.DataFrame(weights, columns=habitat_cols.columns)
+        weights.to_csv("output/habitat_pca_weights.csv")
+        print(f"Habitat PCA explained variance: {variance}")
+        habitat = pd.Series(habitat_pca.squeeze())
+        habitat.index = habitat_cols.index.map(lambda x: benthic_site_map[x])
+        habitat.name = "habitat_pca"
+
+        return habitat
+
+    return _memoised("pca", build)
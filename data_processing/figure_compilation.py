@@ -1,11 +1,9 @@
 from pathlib import Path
-from PIL import Image
 from plot_combiner import PlotCombiner
 
-def combine_images(combiner:PlotCombiner, fls, name, nrows=3, fontsize=54):
+def combine_images(combiner:PlotCombiner, fls, name, nrows=3, fontsize=54, scale=None):
     output_path = f"output/{name}"
-    imgs = [Image.open(x) for x in fls]
-    img = combiner.combine_images(imgs, rows=nrows, add_lettering_of_size=fontsize)
+    img = combiner.composite_files(fls, rows=nrows, add_lettering_of_size=fontsize, scale=scale)
     img.save(output_path, dps=300)
 
 if __name__ == "__main__":
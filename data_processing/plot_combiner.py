@@ -1,20 +1,60 @@
 '''graph combination'''
 import io
 import pickle
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from math import ceil
+from multiprocessing import Pool
 from string import ascii_lowercase
 from pathlib import Path
 from PIL import Image, ImageDraw, ImageFont
 
+def render_spec_png(spec:dict) -> bytes:
+    '''redraw a saved plot spec without writing its output files
+
+    spec: {"plot": Plots method name, "kwargs": arguments, "y_limits": optional (min, max)}
+
+    returns: png image data, as combine_figures would render the figure
+    '''
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib import pyplot as plt
+    from tools.plots import Plots # only needed when re-rendering specs
+
+    fig = getattr(Plots, spec["plot"])(**spec["kwargs"], y_limits=spec.get("y_limits"), save=False)
+    with io.BytesIO() as buf:
+        fig.savefig(buf, format="png")
+        plt.close(fig)
+
+        return buf.getvalue()
+
 class PlotCombiner:
     '''graph combining functions'''
     @classmethod
-    def rescale_figures(cls, filenames):
-        '''combine multiple graphs of one type and re-scale them'''
+    def load_saved_plot(cls, filename):
+        '''load a pickle saved by Plots.save_plt_fig, either a plot spec dict or a legacy matplotlib figure'''
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+
+    @classmethod
+    def rescale_specs(cls, specs):
+        '''give plot specs a shared y axis from 0 to the largest saved y limit'''
+        new_y_max = max(spec["axis"][3] for spec in specs)
+
+        return [{**spec, "y_limits": (0, new_y_max)} for spec in specs]
+
+    @classmethod
+    def rescale_figures(cls, figures):
+        '''combine multiple graphs of one type and re-scale them
+
+        figures: matplotlib figures, or the filenames of pickled figures
+        '''
         models = []
         maxes = []
-        for filename in filenames:
-            model = pickle.load(open(filename, 'rb'))
+        for model in figures:
+            if isinstance(model, (str, Path)):
+                model = cls.load_saved_plot(model)
+
             _, _, _, y_max = model.gca().axis()
             models.append(model)
             maxes.append(y_max)
@@ -27,29 +67,25 @@ class PlotCombiner:
 
     @classmethod
     def combine_figures(cls, plots):
-        '''combine graphs into one image'''
-        bufs = [io.BytesIO() for i in range(len(plots))]
-        try:
-            images=[]
-            for i, fig in enumerate(plots):
-                buf = bufs[i]
-                fig.savefig(buf, format="png")
-                buf.seek(0)
-                images.append(Image.open(buf))
+        '''combine graphs into one image. figures are kept as compressed png data and decoded one at a time'''
+        encoded = []
+        for fig in plots:
+            if isinstance(fig, bytes): # already rendered by render_spec_png
+                encoded.append(fig)
+                continue
 
-            widths, heights = zip(*(i.size for i in images))
-            total_width = sum(widths)
-            max_height = max(heights)
-
-            new_im = Image.new('RGB', (total_width, max_height))
+            with io.BytesIO() as buf:
+                fig.savefig(buf, format="png")
+                encoded.append(buf.getvalue())
 
-            x_offset = 0
-            for im in images:
+        widths, heights = zip(*(_panel_size(x) for x in encoded))
+        new_im = Image.new('RGB', (sum(widths), max(heights)))
+        x_offset = 0
+        for data, width in zip(encoded, widths):
+            with Image.open(io.BytesIO(data)) as im:
                 new_im.paste(im, (x_offset,0))
-                x_offset += im.size[0]
-        finally:
-            for buf in bufs:
-                buf.close()
+
+            x_offset += width
 
         return new_im
 
@@ -84,75 +120,177 @@ class PlotCombiner:
         return graph_types
 
     @classmethod
-    def combine_plots(cls, folder_paths, output_folder, only_include=None):
-        '''wrapper for graph combining process'''
+    def combine_plots(cls, folder_paths, output_folder, only_include=None, n_processes=4):
+        '''wrapper for graph combining process. saved plot specs are rescaled and rendered in parallel, legacy figure
+        pickles are rescaled and combined in this process one set at a time
+
+        n_processes: number of render workers for plot specs
+        '''
         filenames = cls.get_figures_from_folders(folder_paths, only_include)
         graph_types = cls.get_plot_type_from_filename(filenames)
-        for i, graph_set in enumerate(filenames):
-            models = cls.rescale_figures(graph_set)
-            final_fig = cls.combine_figures(models)
-            output_filename = str(output_folder) + f"/combined_{graph_types[i]}.png"
-            final_fig.save(output_filename)
+        with Pool(n_processes) as pool:
+            rendered = []
+            for graph_set, graph_type in zip(filenames, graph_types):
+                saved = [cls.load_saved_plot(x) for x in graph_set]
+                if all(isinstance(x, dict) for x in saved):
+                    rendered.append((graph_type, pool.map_async(render_spec_png, cls.rescale_specs(saved))))
+                    continue
+
+                from matplotlib import pyplot as plt # legacy pickles are matplotlib figures
+                figures = cls.rescale_figures(saved)
+                cls.save_combined(cls.combine_figures(figures), output_folder, graph_type)
+                for fig in figures:
+                    plt.close(fig)
+
+            for graph_type, plots in rendered:
+                cls.save_combined(cls.combine_figures(plots.get()), output_folder, graph_type)
 
     @classmethod
-    def combine_images(cls, images, rows=2, imgs_per_row=None, spacing=20, lgd=None, add_lettering_of_size=54):
-        n_imgs = len(images)
-        if imgs_per_row is None: imgs_per_row = ceil(len(images) / rows)
-        mod = n_imgs % imgs_per_row
-        final = []
-        subset = images
-        if mod:
-            subset = images[:-mod]
-            final = images[-mod:]
+    def save_combined(cls, image, output_folder, graph_type):
+        '''save a combined image as combined_{graph_type}.png'''
+        image.save(str(output_folder) + f"/combined_{graph_type}.png")
 
-        widths, heights = zip(*(i.size for i in subset))
+    @classmethod
+    def layout_panels(cls, sizes, rows=2, imgs_per_row=None, spacing=20, lgd_size=None):
+        '''positions of panels in a grid, as used by combine_images. complete rows are placed left to right, and a
+        final partial row is spread across the width
+
+        sizes: (width, height) of each panel, in order
+        rows: number of rows
+        imgs_per_row: panels per row, defaults to an even split over the rows
+        spacing: pixels between rows, and around the legend
+        lgd_size: (width, height) of a legend placed to the right, or None
+
+        returns: (canvas size, [(x, y) of each panel], (x, y) of the legend or None)
+        '''
+        n_imgs = len(sizes)
+        if imgs_per_row is None: imgs_per_row = ceil(n_imgs / rows)
+        mod = n_imgs % imgs_per_row
+        n_subset = n_imgs - mod
+        widths, heights = zip(*sizes[:n_subset])
         lgd_width = 0
-        if lgd:
-            lgd_width += lgd.size[0] + spacing
+        if lgd_size:
+            lgd_width += lgd_size[0] + spacing
 
         max_width = 0
-        max_height = 0
-        for i in range(0, len(subset), imgs_per_row):
-            row_width = sum(widths[i:i+imgs_per_row])
-            max_width = max(max_width, row_width)
-            max_height += max(heights[i:i+imgs_per_row])
+        for i in range(0, n_subset, imgs_per_row):
+            max_width = max(max_width, sum(widths[i:i+imgs_per_row]))
 
         total_width = max_width + lgd_width
         total_height = ceil(max(heights) * rows) + (rows - 1) * (int(spacing))
 
-        new_im = Image.new('RGB', (total_width, total_height), color="white")
-        if add_lettering_of_size:
-            font = ImageFont.truetype("NotoSansMono-Regular.ttf", add_lettering_of_size)
-
+        positions = []
         x_offset = 0
         y_offset = 0
-        for i, im in enumerate(subset):
-            if add_lettering_of_size:
-                text_im = ImageDraw.Draw(im)
-                text_im.text((0,0), f"({ascii_lowercase[i]})", fill=(0,0,0), font=font)
-
+        for i, (width, height) in enumerate(sizes[:n_subset]):
             if i and rows > 1 and not i % imgs_per_row:
-                y_offset += im.size[1] + spacing
+                y_offset += height + spacing
                 x_offset = 0
 
-            new_im.paste(im, (x_offset,y_offset))
-            x_offset += im.size[0]
+            positions.append((x_offset, y_offset))
+            x_offset += width
 
-        n_subset = i + 1
-        filler = ceil(im.size[0] * (imgs_per_row - len(final)) / imgs_per_row)
+        last_width, last_height = sizes[n_subset - 1]
+        filler = ceil(last_width * (imgs_per_row - mod) / imgs_per_row)
         x_offset = filler
-        y_offset += im.size[1] + spacing
-        for i, im in enumerate(final):
+        y_offset += last_height + spacing
+        for _ in range(mod):
+            positions.append((x_offset, y_offset))
+            x_offset += filler
+
+        lgd_position = None
+        if lgd_size:
+            lgd_position = (total_width - lgd_width - spacing, ceil((total_height / 2) - (lgd_size[1] / 2)) + 10)
+
+        return (total_width, total_height), positions, lgd_position
+
+    @classmethod
+    def combine_images(cls, images, rows=2, imgs_per_row=None, spacing=20, lgd=None, add_lettering_of_size=54):
+        canvas_size, positions, lgd_position = cls.layout_panels([x.size for x in images], rows, imgs_per_row, spacing,
+                                                                 lgd.size if lgd else None)
+        new_im = Image.new('RGB', canvas_size, color="white")
+        if add_lettering_of_size:
+            font = ImageFont.truetype("NotoSansMono-Regular.ttf", add_lettering_of_size)
+
+        for i, (im, position) in enumerate(zip(images, positions)):
             if add_lettering_of_size:
                 text_im = ImageDraw.Draw(im)
-                text_im.text((0,0), f"({ascii_lowercase[n_subset + i]})", fill=(0,0,0), font=font)
+                text_im.text((0,0), f"({ascii_lowercase[i]})", fill=(0,0,0), font=font)
 
-            new_im.paste(im, (x_offset,y_offset))
-            x_offset += filler
+            new_im.paste(im, position)
 
         if lgd:
-            x_offset = total_width - lgd_width - spacing
-            y_offset = ceil((total_height / 2) - (lgd.size[1] / 2)) + 10
-            new_im.paste(lgd, (x_offset,y_offset))
+            new_im.paste(lgd, lgd_position)
 
         return new_im
+
+    @classmethod
+    def composite_files(cls, sources, rows=2, imgs_per_row=None, spacing=20, lgd=None, add_lettering_of_size=54,
+                        scale=None, n_workers=4):
+        '''combine_images for panels on disk, without holding every decoded panel in memory. panel sizes are read from
+        the file headers to lay out a preallocated canvas, then panels are decoded on a thread pool and pasted as they
+        arrive, a few at a time
+
+        sources: image file paths, or encoded image bytes
+        rows, imgs_per_row, spacing, add_lettering_of_size: see combine_images
+        lgd: legend image, file path or image bytes, or None
+        scale: downscale factor applied while reading, e.g. 0.25 for a quick preview. spacing and lettering are scaled
+            to match
+        n_workers: number of decoding threads
+
+        returns: combined image
+        '''
+        sizes = [_panel_size(x) for x in sources]
+        lgd_size = _panel_size(lgd) if lgd is not None else None
+        if scale is not None:
+            sizes = [_scale_size(x, scale) for x in sizes]
+            lgd_size = _scale_size(lgd_size, scale) if lgd_size else None
+            spacing = round(spacing * scale)
+            add_lettering_of_size = round(add_lettering_of_size * scale) if add_lettering_of_size else add_lettering_of_size
+
+        canvas_size, positions, lgd_position = cls.layout_panels(sizes, rows, imgs_per_row, spacing, lgd_size)
+        new_im = Image.new('RGB', canvas_size, color="white")
+        letters = [f"({ascii_lowercase[i]})" if add_lettering_of_size else None for i in range(len(sources))]
+        jobs = [(source, size, letter, position) for source, size, letter, position in zip(sources, sizes, letters, positions)]
+        if lgd is not None:
+            jobs.append((lgd, lgd_size, None, lgd_position))
+
+        with ThreadPoolExecutor(n_workers) as executor:
+            pending = deque()
+            for source, size, letter, position in jobs:
+                pending.append((executor.submit(_load_panel, source, size, letter, add_lettering_of_size), position))
+                if len(pending) >= 2 * n_workers: # bound the number of decoded panels waiting to be pasted
+                    _paste_next(new_im, pending)
+
+            while pending:
+                _paste_next(new_im, pending)
+
+        return new_im
+
+def _as_file(source):
+    return io.BytesIO(source) if isinstance(source, bytes) else source
+
+def _scale_size(size, scale):
+    return (max(round(size[0] * scale), 1), max(round(size[1] * scale), 1))
+
+def _panel_size(source):
+    '''image size from the file header, without decoding. internal use only'''
+    with Image.open(_as_file(source)) as im:
+        return im.size
+
+def _load_panel(source, size, letter, font_size):
+    '''decode a panel, resized to size and lettered as combine_images would. internal use only'''
+    with Image.open(_as_file(source)) as im:
+        panel = im.resize(size, reducing_gap=2.0) if im.size != size else im
+        if letter:
+            font = ImageFont.truetype("NotoSansMono-Regular.ttf", font_size)
+            ImageDraw.Draw(panel).text((0,0), letter, fill=(0,0,0), font=font)
+
+        return panel.convert('RGB')
+
+def _paste_next(canvas, pending):
+    '''paste the oldest decoded panel and release it. internal use only'''
+    future, position = pending.popleft()
+    panel = future.result()
+    canvas.paste(panel, position)
+    panel.close()
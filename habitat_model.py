@@ -1,38 +1,12 @@
 import pandas as pd
-from numpy import NaN, log
+from numpy import NaN
 from scipy.stats import anderson, boxcox
-from rpy2.robjects import r as rcode
+from rpy2.robjects import r as rcode, StrVector
 from tools.gams.gam_link import GamLink
 from backend.diel_vector import benthic_site_map, soundscape_sites
+from backend.habitat import get_habitat_log_ratios
 
-def get_proportional_habitat_cover() -> pd.DataFrame:
-    '''loads the habitat data from file
-
-    returns: dataframe with habitat information
-    '''
-    merge = ["A", "AB", "OT", "SC", "SP"]
-    col = "point_human_group_code"
-    raw_benthic = pd.read_excel('data/benthic_wcp.xlsx')
-    groups = raw_benthic.groupby(['site_name', 'survey_title'])
-    df = groups[col].value_counts(normalize=True).reset_index()
-    date_map = {"Feb": "02", "Nov": "11", "Oct": "10", "Tiles": '02', 'Hydrophone': '10', 'February': "02", "October": "10", "November": "11"}
-    df["month"] = df["survey_title"].apply(lambda x: date_map[x.split(' ')[0]])
-    feb = df[df["month"] == "02"]
-    pivoted = feb.pivot_table('proportion', ['site_name', 'month'], col).reset_index().fillna(0)
-    habitat_cols = pivoted.drop(['site_name', 'month'], axis=1)
-    habitat_cols.index = pivoted["site_name"].apply(lambda x: benthic_site_map[x])
-    habitat_cols["O"] = habitat_cols[merge].sum(axis=1)
-
-    return habitat_cols.drop(merge, axis=1).map(lambda x: 1e-5 if not x else x)
-
-def get_habitat_log_ratios(): # this is not generalisable because dataset knowledge is used
-    habitat_data = get_proportional_habitat_cover()
-    baseline_col = 'O'
-    hab_cols = habitat_data.columns.drop(baseline_col)
-    ratios = habitat_data[hab_cols].div(habitat_data[baseline_col], axis=0)
-    log_ratios = ratios.map(lambda x: log(x))
-
-    return log_ratios
+compiled_models = {} # formula string: first model fitted with it
 
 def get_settlement_data():
     raw_data = pd.read_excel('data/coral_wcp.xlsx')
@@ -79,23 +53,34 @@ def generate_effects_plot(r_link:GamLink, model, effects, title, plot_points=Tru
 
 def generate_pp_checks(r_link:GamLink, model, title, resps):
     filename = f"output/{title}"
-    for resp in resps:
-        dens = glms.pp_check(model, resp) # should potentially use full pca dataset instead of mean points
-        r_link.gr_plot(f"{filename}_density_overlay_{resp}.png", dens)
-
-        scat = glms.pp_check(model, resp, "scatter_avg")
-        r_link.gr_plot(f"{filename}_scatter_avg_{resp}.png", scat)
+    glms.save_pp_checks(model, StrVector(resps), filename) # should potentially use full pca dataset instead of mean points
 
 def hypothesis_checks(glms, model, responses, effects, clas="bsp"):
-    passing = []
-    for resp in responses:
-        for eff in effects:
-            formatted_hyp = f"{resp}_mi{eff} = 0"
-            starred = glms.check_hypothesis(model, formatted_hyp, clas)
-            if starred[0]:
-                passing.append((resp, eff))
+    pairs = [(resp, eff) for resp in responses for eff in effects]
+    hypotheses = StrVector([f"{resp}_mi{eff} = 0" for resp, eff in pairs])
+    starred = glms.check_hypotheses(model, hypotheses, clas)
+
+    return [pair for pair, star in zip(pairs, starred) if star]
+
+def fit_brms_model(glms, rdf, formula_str, file_path, chains=5, cores=5):
+    '''fit a brms model, reusing the compiled Stan model of an earlier fit with the same formula
 
-    return passing
+    glms: loaded brms_models.R source
+    rdf: R data.frame to fit
+    formula_str: R code for the brms formula, see generate_formula
+    file_path: where to save the data and fitted model
+    chains: number of MCMC chains
+    cores: number of chains run in parallel
+
+    returns: fitted brms model
+    '''
+    if formula_str in compiled_models:
+        return glms.update_brms_model(compiled_models[formula_str], rdf, file_path, chains=chains, cores=cores)
+
+    model = glms.generate_brms_model(rdf, rcode(formula_str), file_path, chains=chains, cores=cores)
+    compiled_models[formula_str] = model
+
+    return model
 
 def check_normality(data, effects):
     for effect in effects:
@@ -107,7 +92,7 @@ def model_checks(r_link, model, responses, effect_names):
     tbl = pd.DataFrame(usable_predictors)
     tbl.to_csv(f"output/{band}_mi_{responses}_starred.csv")
 
-def generate_formula(response, multi_response=True):
+def generate_formula(response, multi_response=True, as_string=False):
     if multi_response:
         formula_str = f"brms::bf(brms::mvbind({','.join(response)}) ~ 0 + Intercept + mi(PCA1) + mi(PCA2), family=brms::skew_normal)"
     else:
@@ -120,6 +105,9 @@ def generate_formula(response, multi_response=True):
     formula_str += f"+ brms::bf(PCA1 | mi(sdPCA1) ~ 0 + Intercept, family=gaussian)"
     formula_str += f"+ brms::bf(PCA2 | mi(sdPCA2) ~ 0 + Intercept, family=gaussian)"
     formula_str += "+ brms::set_rescor(FALSE)"
+    if as_string:
+        return formula_str
+
     formula = rcode(formula_str)
 
     return formula
@@ -132,6 +120,7 @@ if __name__ == "__main__":
     effect_names = ["PCA1", "PCA2"]
     responses = ["HC", "MA"]
     bands = ["broad", "fish", "invertebrate"]
+    chains, cores = 5, 5
     settlement_data = get_settlement_data()
     for band in bands:
         pca_points = load_pca_points(band)
@@ -154,8 +143,8 @@ if __name__ == "__main__":
         data = me.drop("Home Taylor")
         data = data.join(settlement_data)
         rdf = r_link.convert_to_rdf(data)
-        formula = generate_formula("settlement", False)
-        model = glms.generate_brms_model(rdf, formula, f"output/{band}_mi_settlement_model.RData")
+        formula = generate_formula("settlement", False, as_string=True)
+        model = fit_brms_model(glms, rdf, formula, f"output/{band}_mi_settlement_model.RData", chains=chains, cores=cores)
         effects = glms.conditional_effects(model, "settlement")
         generate_effects_plot(r_link, model, effects, f"{band}_mi_settlement")
         effect_names = ["PCA1", "PCA2"]
@@ -1,7 +1,10 @@
 import unittest
+from importlib.util import find_spec
+from tempfile import TemporaryDirectory
 import numpy as np
 import pandas as pd
-from tools.pandas_mask import build_mask
+from tools.pandas_mask import build_mask, compile_mask, MaskCache
+from tools.io import write_dataset, load_dataset
 
 class TestMaskBuilder(unittest.TestCase):
     @classmethod
@@ -33,3 +36,45 @@ class TestMaskBuilder(unittest.TestCase):
             self.assertEqual(mask.__repr__(), f"MaskRule: {expected_str}")
             self.assertTrue(expected_mask.equals(mask.mask))
 
+    def test_compiled_mask_engines_and_cache(self):
+        data = self.data.astype(float)
+        data.loc[::4, 'x'] = np.nan
+        fmask = {'&': {'|': [('x', '<', 18), ('y', '>=', 55)], '!': [('y', '()', 40, 45)]}}
+        expected = ((data['x'] < 18) | (data['y'] >= 55)) & ~((data['y'] > 40) & (data['y'] < 45))
+        expression = compile_mask(fmask)
+        self.assertEqual(str(expression), '((x < 18) | (y >= 55)) & (!(40 < y < 45))')
+        for engine in ["numpy", "eval"]:
+            self.assertTrue(expected.equals(expression.evaluate(data, engine=engine)))
+
+        cache = MaskCache()
+        build_mask(data, fmask, cache)
+        n_cached = len(cache)
+        shared = build_mask(data, {'|': [('x', '<', 18), ('y', '>=', 55)]}, cache)
+        self.assertEqual(len(cache), n_cached)
+        self.assertTrue(((data['x'] < 18) | (data['y'] >= 55)).equals(shared.mask))
+        other = data.iloc[::-1].reset_index(drop=True)
+        self.assertTrue(((other['x'] < 18) | (other['y'] >= 55)).equals(build_mask(other, {'|': [('x', '<', 18), ('y', '>=', 55)]}, cache).mask))
+        del other
+        self.assertEqual(len(cache), n_cached)
+        mixed = pd.DataFrame({'x': pd.Series([18, '18', 5], dtype=object)})
+        self.assertEqual(build_mask(mixed, {'|': [('x', '==', 18)]}, cache).mask.tolist(), [True, False, False])
+        self.assertEqual(build_mask(mixed, {'|': [('x', '==', '18')]}, cache).mask.tolist(), [False, True, False])
+
+    @unittest.skipUnless(find_spec("pyarrow"), "pyarrow is not installed")
+    def test_dataset_filter_matches_mask(self):
+        data = self.data.astype(float).assign(datetime=pd.date_range("2022-03-01", periods=len(self.data), freq="h", tz="Australia/Brisbane"))
+        data.loc[::3, 'x'] = np.nan
+        data.loc[::5, 'y'] = np.nan
+        fmask = {'&': {'1': [('band', '==', 'fish')],
+                       '3': [('y', '!=', 50)],
+                       '|': [('x', '[]', 5, 12), ('y', '>', 55), ('x', '!=', 7)],
+                       '!': {'&': [('x', '<', 9), ('y', '<', 45)]},
+                       '2': [('datetime', '<', pd.Timestamp("2022-03-02", tz="Australia/Brisbane"))]}}
+        with TemporaryDirectory() as path:
+            write_dataset({"fish": data, "broad": data}, path, row_group_size=8)
+            loaded = load_dataset(path, fmask, columns=['x', 'y', 'datetime', 'band'])
+
+        in_memory = data.assign(band="fish")
+        expected = in_memory[build_mask(in_memory, fmask).mask].reset_index(drop=True)
+        self.assertTrue(expected['x'].isna().any() and expected['y'].isna().any())
+        pd.testing.assert_frame_equal(loaded[['x', 'y']], expected[['x', 'y']])
@@ -0,0 +1,132 @@
+import re
+import unittest
+from collections import Counter
+import numpy as np
+import pandas as pd
+from backend.diel_vector import get_daily_metrics, get_dailies_for_all_metrics, get_percentile_stats, get_between_within, percentiles, DielSketches, tree_rule_stats, variance_components
+from sklearn.tree import DecisionTreeClassifier, export_text
+from tools.sketches import QuantileSketch
+from tools.definitions import partial_metrics, full_metrics
+
+def looped_daily_metrics(data, metrics):
+    '''the original per-day implementation, used as the reference'''
+    daily_metrics = {metric: [] for metric in metrics}
+    labels = {metric: [] for metric in metrics}
+    data = data.assign(day=data["datetime"].dt.floor('D'))
+    for _, day_data in data.groupby(['day', 'soundtrap']):
+        group = day_data.groupby('scaled_group')
+        for metric in metrics:
+            med = group[metric].quantile(0.5)
+            if len(med) != 20:
+                continue
+            daily_metrics[metric].append(med.sort_index().values.tolist())
+            labels[metric].append(day_data['soundtrap'].unique()[0])
+
+    return daily_metrics, labels
+
+class TestDielVector(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.default_rng(0)
+        frames = []
+        for soundtrap in [7252, 7255, 7259]:
+            times = pd.date_range("2022-03-01", periods=4 * 24 * 60, freq="min", tz="Australia/Brisbane")
+            frame = pd.DataFrame({"datetime": times, "soundtrap": soundtrap})
+            frame["scaled_group"] = (times.hour * 60 + times.minute) // 72
+            for metric in full_metrics:
+                frame[metric] = rng.normal(size=len(frame))
+
+            frames.append(frame)
+
+        data = pd.concat(frames, ignore_index=True)
+        incomplete = (data["soundtrap"] == 7255) & (data["datetime"].dt.day == 2) & (data["scaled_group"] == 3)
+        data = data[~incomplete]
+        missing_d = (data["soundtrap"] == 7259) & (data["datetime"].dt.day == 3) & (data["scaled_group"] == 7)
+        data.loc[missing_d, "D"] = np.nan
+        cls.data = data.reset_index(drop=True)
+
+    def test_daily_metrics_match_loop(self):
+        daily, labels = get_daily_metrics(self.data, partial_metrics)
+        expected, expected_labels = looped_daily_metrics(self.data, partial_metrics)
+        for metric in partial_metrics:
+            np.testing.assert_allclose(daily[metric].values, np.array(expected[metric]))
+            self.assertEqual(labels[metric].tolist(), expected_labels[metric])
+            self.assertEqual(daily[metric].columns[-1], f"{metric}_19")
+
+    def test_dissimilarity_uses_own_days(self):
+        daily, labels = get_dailies_for_all_metrics(self.data)
+        expected, expected_labels = looped_daily_metrics(self.data[~self.data['D'].isna()], ['D'])
+        np.testing.assert_allclose(daily['D'].values, np.array(expected['D']))
+        self.assertEqual(labels['D'].tolist(), expected_labels['D'])
+        self.assertEqual(len(daily['D']), len(daily['lprms']) - 1)
+
+    def test_percentile_stats_match_groupwise(self):
+        stats = get_percentile_stats(self.data, partial_metrics)
+        for (site, group), group_data in self.data.groupby(['soundtrap', 'scaled_group']):
+            for metric in partial_metrics:
+                expected = group_data[metric].quantile(percentiles).tolist() + [group_data[metric].mean()]
+                np.testing.assert_allclose(stats.loc[(site, group), metric].values.astype(float), expected)
+
+    def test_between_within(self):
+        stats = get_percentile_stats(self.data, ['lprms'])
+        proportion = get_between_within(stats, ['lprms'])['lprms']
+        means = self.data.groupby(['scaled_group', 'soundtrap'])['lprms'].mean().unstack()
+        q = self.data.groupby(['scaled_group', 'soundtrap'])['lprms'].quantile([0.05, 0.95]).unstack()
+        ranges = (q[0.95] - q[0.05]).unstack()
+        expected = (ranges.max(axis=1) - ranges.min(axis=1)) / (means.max(axis=1) - means.min(axis=1))
+        self.assertEqual(len(proportion), 20)
+        np.testing.assert_allclose(proportion.values, expected.values)
+
+    def test_sketch_percentiles_within_rank_error(self):
+        k = 50 # small enough that every group is compacted before and after merging
+        partitions = [DielSketches(k, seed=0), DielSketches(k, seed=1)]
+        partitions[0].update('broad', self.data.iloc[::2], partial_metrics)
+        partitions[1].update('broad', self.data.iloc[1::2], partial_metrics)
+        self.assertTrue(all(len(x.compactors) > 1 for x in partitions[0].sketches.values()))
+        merged = DielSketches(k, seed=2).merge(partitions[0]).merge(partitions[1])
+        sketched = merged.percentiles('broad', partial_metrics)
+        for key, sketch in partitions[0].sketches.items():
+            self.assertIsNot(merged.sketches[key], sketch)
+        with self.assertRaises(ValueError):
+            merged.merge(DielSketches(k * 2))
+        exact = get_percentile_stats(self.data, partial_metrics)
+        self.assertTrue(sketched.index.equals(exact.index))
+        np.testing.assert_allclose(sketched.xs("Mean", axis=1, level=1), exact.xs("Mean", axis=1, level=1))
+        error = QuantileSketch.rank_error[k]
+        for (site, group), group_data in self.data.groupby(['soundtrap', 'scaled_group']):
+            for metric in partial_metrics:
+                values = np.sort(group_data[metric].to_numpy())
+                estimates = sketched.loc[(site, group), metric][percentiles].to_numpy(dtype=float)
+                ranks = np.searchsorted(values, estimates, side='right') / len(values)
+                self.assertTrue(np.all(np.abs(ranks - np.array(percentiles)) <= error + 1 / len(values)))
+
+    def test_tree_rule_stats_match_text_export(self):
+        daily, labels = get_daily_metrics(self.data, ['lprms', 'B'])
+        df = pd.concat([daily['lprms'], daily['B']], axis=1)
+        tree = DecisionTreeClassifier(random_state=0).fit(df, labels['lprms'])
+        n_rules, n_locations, index_counts, time_counts, depth = tree_rule_stats(tree, df.columns)
+        rules = export_text(tree, feature_names=list(df.columns), max_depth=depth)
+        splits = re.findall(r"---\s(.+)\s[><=].*\n", rules) # each split appears on two lines
+        self.assertEqual(n_rules, tree.get_n_leaves())
+        self.assertEqual(n_locations, len(set(splits)))
+        self.assertEqual(depth, tree.get_depth())
+        self.assertEqual(sum(index_counts.values()), len(splits) // 2)
+        self.assertEqual(time_counts, Counter({k: v // 2 for k, v in Counter(x.split('_')[1] for x in splits).items()}))
+
+    def test_variance_components_match_balanced_anova(self):
+        rng = np.random.default_rng(1)
+        sites, groups, n = 4, 5, 6
+        design = pd.DataFrame({"soundtrap": np.repeat(np.arange(sites), groups * n),
+                               "scaled_group": np.tile(np.repeat(np.arange(groups), n), sites)})
+        design["y"] = rng.normal(size=sites)[design["soundtrap"]] + rng.normal(size=len(design))
+        design["z"] = design["y"].where(design.index % 7 != 0)
+        components = variance_components(design, ["y", "z"])
+        y = design["y"].to_numpy().reshape(sites, groups, n)
+        grand, site_means, group_means, cell_means = y.mean(), y.mean(axis=(1, 2)), y.mean(axis=(0, 2)), y.mean(axis=2)
+        ms_site = groups * n * ((site_means - grand) ** 2).sum() / (sites - 1)
+        ms_interaction = n * ((cell_means - site_means[:, None] - group_means + grand) ** 2).sum() / ((sites - 1) * (groups - 1))
+        ms_residual = ((y - cell_means[..., None]) ** 2).sum() / (sites * groups * (n - 1))
+        self.assertAlmostEqual(components.at["y", "residual"], ms_residual)
+        self.assertAlmostEqual(components.at["y", "soundtrap"], max((ms_site - ms_interaction) / (groups * n), 0))
+        self.assertAlmostEqual(components.at["y", "interaction"], max((ms_interaction - ms_residual) / n, 0))
+        self.assertTrue(np.isfinite(components.loc["z"].to_numpy(dtype=float)).all())
@@ -0,0 +1,38 @@
+import unittest
+import numpy as np
+import pandas as pd
+from matplotlib import cbook
+from backend.eda import get_box_stats, get_histogram_counts
+
+class TestEda(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.data = pd.DataFrame({"soundtrap": rng.choice([7252, 7255, 7259], 5000),
+                                  "lprms": rng.standard_t(3, 5000)})
+        self.data.loc[::97, "lprms"] = np.nan
+
+    def test_box_stats_match_matplotlib(self):
+        stats = get_box_stats(self.data, "lprms")
+        for site_stats, (site, site_data) in zip(stats, self.data.groupby("soundtrap")):
+            expected = cbook.boxplot_stats(site_data["lprms"].dropna().to_numpy())[0]
+            self.assertEqual(site_stats["label"], site)
+            for key in ["q1", "med", "q3", "whislo", "whishi", "mean"]:
+                self.assertAlmostEqual(site_stats[key], expected[key])
+            np.testing.assert_allclose(np.sort(site_stats["fliers"]), np.sort(expected["fliers"]))
+
+    def test_box_stats_drop_missing_groups(self):
+        data = self.data.astype({"soundtrap": float})
+        data.loc[::13, "soundtrap"] = np.nan
+        stats = get_box_stats(data, "lprms")
+        self.assertEqual([s["label"] for s in stats], sorted(data["soundtrap"].dropna().unique()))
+        for site_stats, (_, site_data) in zip(stats, data.groupby("soundtrap")):
+            self.assertAlmostEqual(site_stats["med"], site_data["lprms"].median())
+
+    def test_histogram_counts_match_hist_bins(self):
+        values = self.data["lprms"]
+        counts, edges = get_histogram_counts(values, 10)
+        expected, expected_edges = np.histogram(values.dropna(), 10)
+        np.testing.assert_array_equal(counts, expected)
+        np.testing.assert_allclose(edges, expected_edges)
+        counts, edges = get_histogram_counts(values.round(), "unique_values")
+        self.assertEqual(len(counts), values.round().nunique())
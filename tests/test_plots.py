@@ -0,0 +1,100 @@
+import hashlib
+import os
+import pickle
+import unittest
+from tempfile import TemporaryDirectory
+import numpy as np
+import pandas as pd
+from matplotlib.figure import Figure
+from backend.clustering import colour_plots
+from tools.plots import Plots, hash_plot_inputs
+
+def digest(*values):
+    h = hashlib.sha256()
+    hash_plot_inputs(values, h)
+    return h.hexdigest()
+
+class TestPlots(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.folder = TemporaryDirectory()
+        os.chdir(self.folder.name)
+        os.mkdir("output")
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.folder.cleanup()
+
+    def test_plot_input_hash_tracks_values(self):
+        rng = np.random.default_rng(0)
+        data = pd.DataFrame({"soundtrap": rng.choice([7252, 7255], 100), "lprms": rng.normal(size=100)})
+        counts, edges = np.histogram(data["lprms"], 10)
+        self.assertEqual(digest(counts, edges, data), digest(counts.copy(), edges.copy(), data.copy()))
+        changed = data.copy()
+        changed.iloc[1, 1] += 1
+        self.assertNotEqual(digest(counts, edges, data), digest(counts, edges, changed))
+        self.assertNotEqual(digest(counts), digest(counts.astype(float)))
+        colours = [(0.1, 0.2, 0.3, 1.0)] * 50
+        self.assertEqual(digest(colours), digest(list(colours)))
+        self.assertNotEqual(digest(colours), digest(colours[:-1] + [(0.1, 0.2, 0.3, 0.5)]))
+        self.assertNotEqual(digest(["1", 2]), digest([1, 2]))
+
+    def test_plot_input_hash_tracks_callback_constants(self):
+        def black(ax):
+            ax.set_facecolor("black")
+
+        def red(ax):
+            ax.set_facecolor("red")
+
+        red.__qualname__ = black.__qualname__
+        self.assertEqual(black.__code__.co_code, red.__code__.co_code)
+        self.assertNotEqual(digest(black), digest(red))
+
+    def test_cached_render_returns_figures(self):
+        kwargs = {"counts": np.arange(4), "edges": np.arange(5), "filename": "hist"}
+        self.assertIsInstance(Plots.histogram_from_counts(**kwargs), Figure)
+        modified = os.stat("output/hist.png").st_mtime_ns
+        self.assertIsInstance(Plots.histogram_from_counts(**kwargs), Figure)
+        self.assertEqual(os.stat("output/hist.png").st_mtime_ns, modified)
+        drawn = Plots.read_manifest()
+        Plots.histogram_from_counts(**{**kwargs, "counts": np.arange(4) + 1})
+        self.assertEqual(len(Plots.read_manifest()), 1)
+        self.assertNotEqual(Plots.read_manifest()["output/hist.png"], drawn["output/hist.png"])
+
+    def test_rasterized_points(self):
+        red, blue = (1., 0., 0., 1.), (0., 0., 1., 1.)
+        image, extent = Plots._rasterize_points([0, 1, 1, np.nan], [0, 1, 1, 5], [red, blue, blue, blue], 1, 2)
+        self.assertEqual(extent, (0, 1, 0, 1))
+        np.testing.assert_allclose(image[0, 0], (1, 0, 0, 0.3 + 0.7 * np.log(2) / np.log(3))) # opacity grows with log density
+        np.testing.assert_allclose(image[1, 1], blue)
+        np.testing.assert_allclose(image[0, 1], 0)
+        np.testing.assert_allclose(image[1, 0], 0)
+        self.assertIsNone(Plots._rasterize_points([np.nan], [np.nan], None, 1, 2))
+
+    def test_colour_plots_rasterize_option(self):
+        rng = np.random.default_rng(0)
+        sites = pd.DataFrame({"soundtrap": rng.choice(["Site A", "Site B", "Site C"], 200)})
+        points = rng.normal(size=(200, 2))
+        for rasterize in [True, False]:
+            fig, = colour_plots(sites, "broad", [(f"PCA_{rasterize}", points)], rasterize=rasterize, bins=16)
+            ax = fig.axes[0]
+            self.assertEqual(len(ax.images), int(rasterize))
+            self.assertEqual(len(ax.collections), int(not rasterize))
+            self.assertEqual(sorted(x.get_text() for x in ax.get_legend().texts), ["Site A", "Site B", "Site C"])
+
+        fig = Plots.scatter_plot([np.nan], [np.nan], ("x", "y"), "empty", rasterize=True)
+        self.assertEqual(len(fig.axes[0].images), 0)
+
+    def test_boxplot_group_saves_drawn_stats(self):
+        rng = np.random.default_rng(0)
+        data = np.column_stack([rng.normal(size=100), rng.normal(5, 2, size=100)])
+        data[0] = [10, -10]
+        fig = Plots.create_boxplot_group(data, ["a", "b"], "boxes", "box", show_outliers=False)
+        self.assertEqual([x.get_text() for x in fig.axes[0].get_xticklabels()], ["a", "b"])
+        with open("output/box.png.pkl", "rb") as f:
+            spec = pickle.load(f)
+
+        self.assertEqual(spec["plot"], "boxplot_group_from_stats")
+        self.assertEqual([x["label"] for x in spec["kwargs"]["stats"]], ["a", "b"])
+        np.testing.assert_allclose([x["med"] for x in spec["kwargs"]["stats"]], np.median(data, axis=0))
+        self.assertTrue(all(len(x["fliers"]) == 0 for x in spec["kwargs"]["stats"]))
@@ -0,0 +1,42 @@
+import pickle
+import unittest
+import numpy as np
+from tools.sketches import QuantileSketch
+
+class TestQuantileSketch(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        rng = np.random.default_rng(0)
+        cls.values = rng.lognormal(size=200_000)
+        cls.sorted_values = np.sort(cls.values)
+        cls.quantiles = [0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95]
+
+    def rank_errors(self, sketch):
+        estimates = sketch.quantile(self.quantiles)
+        ranks = np.searchsorted(self.sorted_values, estimates) / len(self.values)
+        return np.abs(ranks - self.quantiles)
+
+    def test_streamed_updates(self):
+        sketch = QuantileSketch(seed=0)
+        for chunk in np.array_split(self.values, 50):
+            sketch.update(chunk)
+
+        self.assertEqual(sketch.n, len(self.values))
+        self.assertLess(len(sketch), 3 * sketch.k)
+        self.assertTrue(np.all(self.rank_errors(sketch) <= QuantileSketch.rank_error[200]))
+        self.assertAlmostEqual(sketch.mean(), self.values.mean())
+
+    def test_merged_partitions(self):
+        parts = [QuantileSketch(seed=i).update(chunk) for i, chunk in enumerate(np.array_split(self.values, 8))]
+        merged = parts[0]
+        for part in parts[1:]:
+            merged.merge(part)
+
+        merged = pickle.loads(pickle.dumps(merged))
+        self.assertEqual(merged.n, len(self.values))
+        self.assertTrue(np.all(self.rank_errors(merged) <= QuantileSketch.rank_error[200]))
+
+    def test_empty_and_nan(self):
+        sketch = QuantileSketch().update([np.nan, np.nan])
+        self.assertEqual(sketch.n, 0)
+        self.assertTrue(np.isnan(sketch.quantile(0.5)))
@@ -84,6 +84,30 @@ class Astronomy:
         abs_diffs = abs(transition_times - sample_time)
         return transition_times[abs_diffs.idxmin()]
 
+    def nearest_event_times(self, event_times, sample_times, return_diffs=False):
+        '''vectorised equivalent of get_closest_time for a whole series of sample times
+
+        event_times: series of event times, sorted ascending
+        sample_times: series of times to find the closest event for
+        return_diffs: also return the absolute distance to the closest event, in nanoseconds
+
+        returns: series of closest event times, indexed like sample_times
+        '''
+        events = pd.DatetimeIndex(event_times).as_unit('ns')
+        samples = pd.DatetimeIndex(sample_times).as_unit('ns').asi8
+        event_ns = events.asi8
+        after = np.clip(np.searchsorted(event_ns, samples), 1, len(event_ns) - 1)
+        before = after - 1
+        before_diffs = np.abs(samples - event_ns[before])
+        after_diffs = np.abs(event_ns[after] - samples)
+        use_before = before_diffs <= after_diffs # ties go to the earlier event, as with idxmin
+        closest = np.where(use_before, before, after)
+        closest_times = pd.Series(events[closest], index=sample_times.index)
+        if return_diffs:
+            return closest_times, np.where(use_before, before_diffs, after_diffs)
+
+        return closest_times
+
     def get_closest_sun_transition(self, risings, settings, x):
         rise_diffs = abs(risings - x)
         set_diffs = abs(settings - x)
@@ -92,7 +116,7 @@ class Astronomy:
         else:
             return (-1, settings[set_diffs.idxmin()])
 
-    def find_closest_sun_event_times(self, data, location_col, date_col, set_times:SunTransitions):
+    def find_closest_sun_event_times(self, data, location_col, date_col, set_times:SunTransitions, vectorised=False):
         loc_times = {}
         for loc, loc_data in data.groupby(location_col):
             if loc == (None, None): continue
@@ -110,6 +134,9 @@ class Astronomy:
                 rise_times = self.find_suntimes(lat, lon, loc_data[date_col], func=almanac.find_risings)
                 loc_times[loc] = (rise_times, setting_times)
 
+        if vectorised:
+            return self._vectorised_closest_sun_events(data, location_col, date_col, loc_times, set_times)
+
         if set_times != SunTransitions.Transitions:
             transition_times = data.apply(lambda x: self.get_closest_time(loc_times[x[location_col]], x[date_col]), axis=1)
         else:
@@ -117,6 +144,26 @@ class Astronomy:
 
         return transition_times
 
+    def _vectorised_closest_sun_events(self, data, location_col, date_col, loc_times, set_times):
+        '''per-location searchsorted lookup of the closest sun events. internal use only'''
+        results = []
+        for loc, loc_data in data.groupby(location_col):
+            if loc not in loc_times: continue
+            samples = loc_data[date_col]
+            if set_times != SunTransitions.Transitions:
+                results.append(self.nearest_event_times(loc_times[loc], samples))
+                continue
+
+            rise_times, setting_times = loc_times[loc]
+            rises, rise_diffs = self.nearest_event_times(rise_times, samples, return_diffs=True)
+            sets, set_diffs = self.nearest_event_times(setting_times, samples, return_diffs=True)
+            use_rise = rise_diffs < set_diffs
+            modifiers = np.where(use_rise, 1, -1)
+            times = rises.where(use_rise, sets)
+            results.append(pd.Series(list(zip(modifiers, times)), index=samples.index))
+
+        return pd.concat(results).reindex(data.index)
+
     def scale_day(self, rise_times, set_times, middays, midnights, x):
         def get_closest(diffs, time):
             return time[np.argmin(diffs)]
@@ -144,7 +191,24 @@ class Astronomy:
 
         return anti_lat, anti_lon
 
-    def find_scaled_day_percentage(self, data, location_col, date_col):
+    def scale_days(self, rise_times, set_times, middays, midnights, samples) -> pd.Series:
+        '''vectorised equivalent of scale_day for a whole series of sample times at one location'''
+        rise, sunset, midday, midnight = (self.nearest_event_times(x, samples) for x in (rise_times, set_times, middays, midnights))
+        conditions = [(samples > rise) & (samples <= midday),
+                      (samples > midday) & (samples <= sunset),
+                      (samples > sunset) & (samples <= midnight),
+                      (samples > midnight) & (samples <= rise)]
+        scaled = [25 + (samples - rise) / (midday - rise) * 25,
+                  50 + (samples - midday) / (sunset - midday) * 25,
+                  75 + (samples - sunset) / (midnight - sunset) * 25,
+                  0 + (samples - midnight) / (rise - midnight) * 25]
+        matched = np.any(conditions, axis=0)
+        if not matched.all():
+            raise RuntimeError("My logic is incorrect")
+
+        return pd.Series(np.select(conditions, scaled), index=samples.index)
+
+    def find_scaled_day_percentage(self, data, location_col, date_col, vectorised=False):
         loc_times = {}
         for loc, loc_data in data.groupby(location_col):
             if loc == (None, None): continue
@@ -156,4 +220,9 @@ class Astronomy:
             solar_midnight = self.find_suntimes(opp_lat, opp_lon, loc_data[date_col], func=almanac.find_transits)
             loc_times[loc] = (rise_times, setting_times, solar_midday, solar_midnight)
 
+        if vectorised:
+            scaled = [self.scale_days(*loc_times[loc], loc_data[date_col])
+                      for loc, loc_data in data.groupby(location_col) if loc in loc_times]
+            return pd.concat(scaled).reindex(data.index)
+
         return data.apply(lambda x: self.scale_day(*loc_times[x[location_col]], x[date_col]), axis=1)
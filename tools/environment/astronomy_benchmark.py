@@ -0,0 +1,106 @@
+'''timing and agreement checks for the Astronomy entry points used by format_data'''
+from datetime import datetime
+from zoneinfo import ZoneInfo
+import numpy as np
+import pandas as pd
+from tools.environment.astronomy import Astronomy, SunTransitions
+from tools.environment.locations import KeppelMiddleIsland
+from tools.timing import time_call
+
+default_sizes = [(1, 1), (1, 7), (4, 7), (4, 28), (11, 28)] # (sites, days)
+
+def generate_timestamps(n_sites:int, n_days:int, start=datetime(2022, 3, 1), site_spacing=0.01) -> pd.DataFrame:
+    '''create minute-level timestamps for a grid of sites, formatted as in format_data
+
+    n_sites: number of sites, spaced out from the Keppel Middle Island location
+    n_days: number of days of minute timestamps per site
+    start: first timestamp
+    site_spacing: degrees of latitude and longitude between neighbouring sites
+
+    returns: dataframe with "location" and "datetime" columns
+    '''
+    tz = ZoneInfo(KeppelMiddleIsland.timezone)
+    times = pd.date_range(start.replace(tzinfo=tz), periods=n_days * 24 * 60, freq="min")
+    lat, lon = KeppelMiddleIsland.location
+    frames = []
+    for i in range(n_sites):
+        location = (str(lat + i * site_spacing), str(lon + i * site_spacing))
+        frames.append(pd.DataFrame({"location": [location] * len(times), "datetime": times}))
+
+    return pd.concat(frames, ignore_index=True)
+
+def max_difference(reference:pd.Series, fast:pd.Series) -> float:
+    '''largest absolute disagreement between two result series, in hours for times'''
+    if isinstance(reference.iloc[0], tuple): # sun transitions are (modifier, time) pairs
+        if (reference.str[0] != fast.str[0]).any():
+            return np.inf
+
+        reference, fast = reference.str[1], fast.str[1]
+
+    if pd.api.types.is_numeric_dtype(reference):
+        return float((reference - fast).abs().max())
+
+    diffs = (pd.to_datetime(reference) - pd.to_datetime(fast)).abs()
+
+    return diffs.max().total_seconds() / 3600
+
+def entry_points(astro:Astronomy) -> dict:
+    '''the Astronomy calls made by format_data, as {name: (reference, fast path or None)}'''
+    entries = {}
+    for transition in SunTransitions:
+        reference = lambda data, t=transition: astro.find_closest_sun_event_times(data, "location", "datetime", set_times=t)
+        fast = lambda data, t=transition: astro.find_closest_sun_event_times(data, "location", "datetime", set_times=t, vectorised=True)
+        entries[f"closest_{transition.value}"] = (reference, fast)
+
+    entries["scaled_day"] = (lambda data: astro.find_scaled_day_percentage(data, "location", "datetime"),
+                             lambda data: astro.find_scaled_day_percentage(data, "location", "datetime", vectorised=True))
+    entries["moon_phase"] = (lambda data: pd.Series(astro.moon_phase_at_date(data["datetime"])), None)
+
+    return entries
+
+def benchmark(sizes=None, repeats=1, reference_row_limit=200_000) -> pd.DataFrame:
+    '''time each Astronomy entry point over increasing numbers of sites and days
+
+    sizes: list of (n_sites, n_days)
+    repeats: number of timing runs per call, the fastest is kept
+    reference_row_limit: skip the row-wise reference implementations above this many rows
+
+    returns: dataframe of timings, throughput, growth and fast path agreement
+    '''
+    astro = Astronomy()
+    sizes = default_sizes if sizes is None else sizes
+    rows = []
+    for n_sites, n_days in sizes:
+        data = generate_timestamps(n_sites, n_days)
+        n_events = n_sites * (n_days + 2) # events searched per event type, one per day with a day either side
+        for name, (reference, fast) in entry_points(astro).items():
+            result = {"entry": name, "sites": n_sites, "days": n_days, "rows": len(data), "events": n_events}
+            ref_result = None
+            if len(data) <= reference_row_limit or fast is None:
+                seconds, ref_result = time_call(reference, data, repeats=repeats)
+                result["reference_s"] = seconds
+                result["reference_rows_per_s"] = len(data) / seconds
+
+            if fast is not None:
+                seconds, fast_result = time_call(fast, data, repeats=repeats)
+                result["fast_s"] = seconds
+                result["fast_rows_per_s"] = len(data) / seconds
+                if ref_result is not None:
+                    result["max_difference"] = max_difference(ref_result, fast_result)
+
+            rows.append(result)
+
+    results = pd.DataFrame(rows)
+    grouped = results.groupby("entry")
+    size_change = np.log(results["rows"] / grouped["rows"].shift())
+    for col in ["reference_s", "fast_s"]:
+        if col in results: # log-log slope between successive sizes, 1 means linear scaling
+            results[f"{col[:-2]}_growth"] = np.log(results[col] / grouped[col].shift()) / size_change
+
+    return results
+
+if __name__ == "__main__":
+    results = benchmark()
+    results.to_csv("output/astronomy_benchmark.csv", index=False)
+    with pd.option_context("display.max_columns", None, "display.width", 200):
+        print(results)
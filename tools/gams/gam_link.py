@@ -1,13 +1,21 @@
+import hashlib
+import json
+import shutil
 from pathlib import Path
-from rpy2.robjects import r as rcode
-from .r_plotter import rPlotter
+from .r_plotter import rPlotter, get_robjects
+
+gam_engines = ("gam", "bam")
 
 class GamLink(rPlotter):
+    fitting_scripts = ("general", "gam_models") # R sources whose edits invalidate cached model sets
+
     def __init__(self):
         super().__init__()
         path = Path(__file__).parent / "gam_models.R"
         self.gam = self.load_src(path)
         self.output_path = "output"
+        self.cache_path = Path("output/gam_cache")
+        self.use_cache = True
         self.log = print
 
     def _process_var_list(self, vars, r_str):
@@ -18,7 +26,17 @@ class GamLink(rPlotter):
 
         return f"{r_str}=c({joined_vars}),"
 
-    def generate_gam_model_code(self, output_var, predictors, factor_vars, cyclic_vars, random_effects, k=5):
+    def generate_gam_model_code(self, output_var, predictors, factor_vars, cyclic_vars, random_effects, k=5, engine="gam", nthreads=1):
+        '''R code for the base model and FSSgam candidate model set. candidates are refitted from the base model, so
+        they use the same engine
+
+        engine: "gam" for mgcv::gam, or "bam" for mgcv::bam with discretised covariates, suited to large data
+        nthreads: threads used by bam
+        '''
+        if engine not in gam_engines:
+            raise ValueError(f"Unknown GAM engine {engine}, expected one of {gam_engines}")
+
+        engine_args = f", discrete=TRUE, nthreads={nthreads}" if engine == "bam" else ""
         form_re = " + " + " + ".join([f"s({x}, bs='re', k={k})" for x in random_effects]) if random_effects else ""
         formula_string = f"{output_var} ~ s({predictors[0]}, bs='cr', k={k})" + form_re
         n_predictors = min(len(predictors) + len(factor_vars), 5)
@@ -26,7 +44,7 @@ class GamLink(rPlotter):
         factor_vars = self._process_var_list(factor_vars, "pred.vars.fact")
         cyclic_vars = self._process_var_list(cyclic_vars, "cyclic.vars")
         random_effects = self._process_var_list(random_effects, "null.terms")
-        return(f"Model1 <- mgcv::gam({formula_string}, family=mgcv::tw(), data=use.dat)\n"
+        return(f"Model1 <- mgcv::{engine}({formula_string}, family=mgcv::tw(), data=use.dat{engine_args})\n"
                 "model.set <- FSSgam::generate.model.set(use.dat=use.dat,"
                 "test.fit=Model1,"
                 f"{predictors}"
@@ -39,12 +57,79 @@ class GamLink(rPlotter):
                 "smooth.smooth.interactions=T)"
         )
 
-    def fss_gam(self, data, output_var, continuous_vars, factor_vars, cyclic_vars, random_effects, name, k=5):
-        self.gam.assign_data_to_parent_env(data)
-        gam_code = self.generate_gam_model_code(output_var, continuous_vars, factor_vars, cyclic_vars, random_effects, k=k)
+    def data_digest(self, data) -> str:
+        '''content hash of an R data.frame. serialises the whole frame, so compute it once per frame and pass it to
+        fss_gam for each model set fitted to that frame'''
+        return self.r_src.data_md5(data)[0]
+
+    def model_set_key(self, data_hash, gam_code, name, k, *var_lists) -> str:
+        '''content hash identifying a model set, from the data contents, generated code, settings and the R scripts
+        that fit and save it
+
+        data_hash: content hash of the data the model set is fitted to, see data_digest
+        gam_code: output of generate_gam_model_code
+        name: name used for the output files
+        k: basis dimension
+        var_lists: predictor lists passed to generate_gam_model_code
+
+        returns: hex digest
+        '''
+        scripts = [self.source_digest(x) for x in self.fitting_scripts]
+        spec = json.dumps([data_hash, gam_code, name, k, [list(x) for x in var_lists], scripts])
+
+        return hashlib.sha256(spec.encode()).hexdigest()
+
+    def fss_gam(self, data, output_var, continuous_vars, factor_vars, cyclic_vars, random_effects, name, k=5, parallel=True,
+                use_cache=None, invalidate=False, engine="gam", nthreads=1, data_hash=None):
+        '''fit a FSSgam model set and save its model table, variable importance and best model plots
+
+        use_cache: reuse the saved outputs of an identical earlier fit. defaults to self.use_cache
+        invalidate: discard any cached fit for this model set and refit it
+        engine, nthreads: see generate_gam_model_code
+        data_hash: content hash of data, from data_digest. computed here if not given
+        '''
+        use_cache = self.use_cache if use_cache is None else use_cache
+        gam_code = self.generate_gam_model_code(output_var, continuous_vars, factor_vars, cyclic_vars, random_effects, k=k,
+                                                engine=engine, nthreads=nthreads)
         self.log(gam_code)
-        rcode(gam_code)
+        save_path = self.output_path
+        cache_fit = use_cache or invalidate
+        if cache_fit:
+            data_hash = self.data_digest(data) if data_hash is None else data_hash
+            key = self.model_set_key(data_hash, gam_code, name, k, continuous_vars, factor_vars, cyclic_vars, random_effects)
+            entry = self.cache_path / key
+            if invalidate and entry.exists():
+                shutil.rmtree(entry)
+
+            if use_cache and (entry / "complete").is_file():
+                self.log(f"Using cached model set for {name}")
+                self._copy_outputs(entry, self.output_path)
+                return
+
+            if entry.exists(): # left over from an interrupted fit
+                shutil.rmtree(entry)
+
+            entry.mkdir(parents=True)
+            save_path = entry
+
+        self.gam.assign_data_to_parent_env(data)
+        get_robjects().r(gam_code)
         for factor in factor_vars:
             self.change_col_to_factor(data, factor)
 
-        self.gam.soundtrap_model_set(self.output_path, name)
+        self.gam.soundtrap_model_set(str(save_path), name, parallel)
+        if cache_fit:
+            (entry / "complete").touch()
+            self._copy_outputs(entry, self.output_path)
+
+    @classmethod
+    def _copy_outputs(cls, source, destination):
+        '''copy the files saved for a model set into the output folder. internal use only'''
+        Path(destination).mkdir(parents=True, exist_ok=True)
+        for path in Path(source).iterdir():
+            if path.name != "complete":
+                shutil.copy2(path, Path(destination) / path.name)
+
+    def clear_gam_cache(self):
+        '''remove every cached model set'''
+        shutil.rmtree(self.cache_path, ignore_errors=True)
@@ -1,18 +1,46 @@
+import hashlib
+from functools import cache
 from pathlib import Path
-from rpy2 import rinterface_lib
-from rpy2.robjects import pandas2ri, FactorVector
-from rpy2.robjects.packages import importr
-import rpy2.robjects as robjects
-from rpy2.robjects.packages import STAP
 
-Rplus = robjects.r['+']
+_sources = {} # resolved script path: parsed package, shared by every rPlotter in the process
+_source_digests = {} # resolved script path: content hash of the text that was parsed
+
+@cache
+def get_robjects():
+    '''rpy2.robjects, which starts the embedded R session when first imported'''
+    import rpy2.robjects as robjects
+
+    return robjects
+
+@cache
+def import_r_package(name:str):
+    '''import an R package once per process'''
+    from rpy2.robjects.packages import importr
+
+    return importr(name)
+
+def Rplus(a, b):
+    return get_robjects().r['+'](a, b)
+
+class RPackage:
+    '''class attribute that imports its R package the first time it is accessed'''
+    def __init__(self, name:str):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        return import_r_package(self.name)
+
+class RNull:
+    '''class attribute for R's NULL, available once R has started'''
+    def __get__(self, instance, owner):
+        return get_robjects().rinterface.NULL
 
 class rPlotter:
-    grDevices = importr('grDevices')
-    base = importr('base')
-    gg = importr('ggplot2')
-    stats = importr('stats')
-    null_value = robjects.rinterface.NULL
+    grDevices = RPackage('grDevices')
+    base = RPackage('base')
+    gg = RPackage('ggplot2')
+    stats = RPackage('stats')
+    null_value = RNull()
     available_scripts = {x.stem: x for x in Path(__file__).parent.resolve().glob('*.R')}
 
     def __init__(self) -> None:
@@ -21,33 +49,74 @@ class rPlotter:
 
     @classmethod
     def load_src(cls, source):
+        '''parse an R script into a package of its functions. each script is only read and parsed once per process
+
+        source: path to the script, or the name of a script in this folder
+        '''
+        path = cls._script_path(source)
+        if path not in _sources:
+            from rpy2.robjects.packages import STAP
+            with open(path, 'r') as f:
+                inpt = f.read()
+
+            _sources[path] = STAP(inpt, "str")
+            _source_digests[path] = hashlib.sha256(inpt.encode()).hexdigest()
+
+        return _sources[path]
+
+    @classmethod
+    def source_digest(cls, source) -> str:
+        '''content hash of an R script, as parsed by load_src if it has been loaded
+
+        source: path to the script, or the name of a script in this folder
+        '''
+        path = cls._script_path(source)
+        if path not in _source_digests:
+            return hashlib.sha256(path.read_bytes()).hexdigest()
+
+        return _source_digests[path]
+
+    @classmethod
+    def _script_path(cls, source) -> Path:
+        '''resolved path of a script name or path. internal use only'''
         if source in cls.available_scripts:
             source = cls.available_scripts[source]
 
-        with open(source, 'r') as f:
-            inpt = f.read()
-
-        return STAP(inpt, "str")
+        return Path(source).resolve()
 
     @classmethod
     def save_workspace(cls, path):
         cls.base.save_image(str(path))
 
-    def convert_to_rdf(self, df):
+    def convert_to_rdf(self, df, factors=()):
+        '''copy a dataframe into an R data.frame, with the index as row names
+
+        df: dataframe to convert
+        factors: columns to convert to R factors
+
+        returns: R data.frame
+        '''
+        from rpy2.robjects import pandas2ri
         context = self.context()
         with context():
-            return pandas2ri.py2rpy(df)
+            rdf = pandas2ri.py2rpy(df)
+
+        for col in factors:
+            self.change_col_to_factor(rdf, col)
+
+        return rdf
 
     @classmethod
     def convert_to_df(cls, rdf):
         context = cls.context()
         with context():
-            df = robjects.conversion.get_conversion().rpy2py(rdf)
+            df = get_robjects().conversion.get_conversion().rpy2py(rdf)
 
         return df
 
     @classmethod
     def change_col_to_factor(cls, r_df, col):
+        from rpy2.robjects import FactorVector
         col_index = list(r_df.colnames).index(col)
         col_vals = FactorVector(r_df.rx2(col))
         r_df[col_index] = col_vals
@@ -62,7 +131,8 @@ class rPlotter:
         cls.grDevices.dev_off() # pylint: disable=no-member
 
     def context(self):
-        return (robjects.default_converter + pandas2ri.converter).context
+        from rpy2.robjects import pandas2ri
+        return (get_robjects().default_converter + pandas2ri.converter).context
 
     @classmethod
     def capture_rpy2_output(cls, errorwarn_callback=None, print_callback=None):
@@ -73,5 +143,6 @@ class rPlotter:
         if not errorwarn_callback:
             errorwarn_callback = lambda x: None
 
-        rinterface_lib.callbacks.consolewrite_print = print_callback
-        rinterface_lib.callbacks.consolewrite_warnerror = errorwarn_callback
+        from rpy2.rinterface_lib import callbacks
+        callbacks.consolewrite_print = print_callback
+        callbacks.consolewrite_warnerror = errorwarn_callback
@@ -1,5 +1,8 @@
 import pickle
+from multiprocessing import shared_memory
 from pathlib import Path
+import numpy as np
+from tools.pandas_mask import compile_mask
 
 def get_project_root() -> Path:
     return Path(__file__).parent.parent.parent.parent
@@ -31,3 +34,66 @@ def unpickle_data(filename, check_data_folder=True):
         data = pickle.load(f)
 
     return data
+
+
+def share_array(arr) -> tuple:
+    '''copy an array into a shared memory block that worker processes can attach to without pickling
+
+    arr: array to share
+
+    returns: (shared memory block, descriptor for attach_array). the caller must close and unlink the block
+    '''
+    arr = np.ascontiguousarray(arr)
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[:] = arr
+    descriptor = {"name": shm.name, "shape": arr.shape, "dtype": arr.dtype.str}
+
+    return shm, descriptor
+
+def attach_array(descriptor:dict) -> tuple:
+    '''attach to an array shared by share_array, without copying it
+
+    descriptor: descriptor returned by share_array
+
+    returns: (shared memory block, array view). delete the view before closing the block
+    '''
+    shm = shared_memory.SharedMemory(name=descriptor["name"])
+    arr = np.ndarray(descriptor["shape"], dtype=np.dtype(descriptor["dtype"]), buffer=shm.buf)
+
+    return shm, arr
+
+def write_dataset(sscodes:dict, path, row_group_size=100_000) -> None:
+    '''save data for each band as a parquet dataset, partitioned by band so that filtered loads skip the other bands.
+    the row groups of time ordered data cover short time spans, so date filters skip most of them
+
+    sscodes: {band: dataframe}
+    path: dataset folder. partitions for these bands are replaced
+    row_group_size: maximum rows per row group, the unit that filters skip
+    '''
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    partitioning = ds.partitioning(pa.schema([("band", pa.string())]), flavor="hive")
+    for band, data in sscodes.items():
+        table = pa.Table.from_pandas(data.assign(band=band), preserve_index=False)
+        ds.write_dataset(table, path, format="parquet", partitioning=partitioning, basename_template=f"{band}-{{i}}.parquet",
+                         existing_data_behavior="delete_matching", max_rows_per_group=row_group_size,
+                         max_rows_per_file=10 * row_group_size)
+
+def load_dataset(path, faux_mask:dict=None, columns:list=None):
+    '''load the rows of a dataset saved by write_dataset that match a faux mask. the mask is applied while reading, so
+    only the matching partitions and row groups are read
+
+    path: dataset folder
+    faux_mask: nested dict of rules, see tools.pandas_mask.compile_mask. "band" can be used to select bands
+    columns: columns to load, defaults to all
+
+    returns: dataframe of the matching rows
+    '''
+    import pyarrow.dataset as ds
+
+    expression = compile_mask(faux_mask)
+    dataset = ds.dataset(path, format="parquet", partitioning="hive")
+    table = dataset.to_table(columns=columns, filter=None if expression is None else expression.to_arrow_filter())
+
+    return table.to_pandas()
@@ -1,13 +1,71 @@
-from sklearn.decomposition import PCA
-from sklearn.preprocessing import scale
-
-def pca_nd(data, n=2):
-    # df = (data - data.min()) / (data.max() - data.min()).astype(float)
-    df = scale(data)
-    pca = PCA(n_components=n)
-    pca.fit(df)
-    output = pca.transform(df)
-    weights =  pca.components_
+import numpy as np
+from sklearn.decomposition import PCA, IncrementalPCA
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+
+pca_backends = ("exact", "randomized", "incremental")
+
+def iter_row_chunks(data, batch_size:int, dtype=None, min_rows:int=1):
+    '''yield row blocks of an array, dataframe, memory-mapped array, or list of pre-chunked arrays
+
+    data: input rows. a list is treated as already chunked
+    batch_size: rows per block
+    dtype: dtype to convert each block to
+    min_rows: a trailing block smaller than this is merged into the previous block
+    '''
+    if isinstance(data, list):
+        for chunk in data:
+            yield np.asarray(chunk, dtype=dtype)
+        return
+
+    rows = data.iloc if hasattr(data, "iloc") else data
+    starts = list(range(0, len(data), batch_size))
+    if len(starts) > 1 and len(data) - starts[-1] < min_rows:
+        starts.pop()
+
+    ends = starts[1:] + [len(data)]
+    for start, end in zip(starts, ends):
+        yield np.asarray(rows[start:end], dtype=dtype)
+
+def pca_nd(data, n=2, backend="exact", dtype=None, batch_size=100_000, random_state=0):
+    '''standardise data and reduce it to n principal components
+
+    data: array, dataframe or memory-mapped array of shape (samples, features). the incremental backend
+        also accepts a list of row chunks
+    n: number of components
+    backend: "exact" for sklearn's default PCA solver, "randomized" for a randomized SVD, or "incremental" to
+        fit in mini-batches of batch_size rows, holding only one batch in memory at a time
+    dtype: dtype to compute in, e.g. np.float32 to halve memory. defaults to the input dtype
+    batch_size: rows per mini-batch for the incremental backend
+    random_state: seed for the randomized solver
+
+    returns: projected data, component weights, explained variance ratios, fitted scaler + PCA pipeline. the
+        pipeline projects new data exactly as the returned points were projected
+    '''
+    if backend not in pca_backends:
+        raise ValueError(f"Unknown PCA backend {backend}, expected one of {pca_backends}")
+
+    if backend == "incremental":
+        scaler = StandardScaler()
+        for chunk in iter_row_chunks(data, batch_size, dtype, n):
+            scaler.partial_fit(chunk)
+
+        pca = IncrementalPCA(n_components=n)
+        for chunk in iter_row_chunks(data, batch_size, dtype, n):
+            pca.partial_fit(scaler.transform(chunk))
+
+        output = np.concatenate([pca.transform(scaler.transform(chunk)) for chunk in iter_row_chunks(data, batch_size, dtype, n)])
+    else:
+        if isinstance(data, list):
+            data = np.concatenate(data)
+
+        scaler = StandardScaler()
+        df = scaler.fit_transform(np.asarray(data, dtype=dtype))
+        pca = PCA(n_components=n, svd_solver="randomized" if backend == "randomized" else "auto", random_state=random_state)
+        output = pca.fit_transform(df)
+
+    weights = pca.components_
     variance = pca.explained_variance_ratio_
+    model = Pipeline([("scale", scaler), ("pca", pca)])
 
-    return output, weights, variance, pca
\ No newline at end of file
+    return output, weights, variance, model
@@ -1,6 +1,9 @@
 from abc import ABC, abstractmethod
 from collections.abc import Iterable
+from functools import reduce
 import operator as op
+import weakref
+import numpy as np
 import pandas as pd
 
 class Range(ABC):
@@ -101,34 +104,300 @@ class CombinedRules(Rule):
 
         self.mask = base
 
-def build_mask(data:pd.DataFrame, faux_mask:dict):
+class MaskCache:
+    '''sub-expression results of compiled masks, kept apart for every dataframe they were evaluated on. results
+    for a dataframe are dropped when it is garbage collected, and are only valid while it is not modified'''
+    def __init__(self):
+        self._frames = {}
+
+    def for_data(self, data:pd.DataFrame) -> dict:
+        '''results cached for this dataframe object'''
+        entry = self._frames.get(id(data))
+        if entry is None or entry[0]() is not data: # a recycled id belongs to a new object
+            key = id(data)
+            entry = (weakref.ref(data, lambda _: self._frames.pop(key, None)), {})
+            self._frames[key] = entry
+
+        return entry[1]
+
+    def __len__(self):
+        return sum(len(results) for _, results in self._frames.values())
+
+class Expression(ABC):
+    '''node of a compiled mask. evaluates to a boolean array over the rows of a dataframe'''
+    str = ""
+    key = ""
+    refs = () # objects identified by id in the key, kept alive with the cached result
+
+    def evaluate(self, data:pd.DataFrame, cache:MaskCache=None, engine="numpy") -> pd.Series:
+        '''boolean mask of the rows matching the expression
+
+        data: dataframe to evaluate on
+        cache: MaskCache of sub-expression results, shared between masks
+        engine: "numpy" to combine numpy arrays, or "eval" for a single DataFrame.eval pass
+
+        returns: boolean series with the index of data
+        '''
+        if engine == "eval":
+            query, values = self.to_query()
+            return data.eval(query, local_dict=values).astype(bool)
+
+        if engine != "numpy":
+            raise ValueError(f"Unknown engine {engine}")
+
+        results = {} if cache is None else cache.for_data(data)
+
+        return pd.Series(self.values(data, results), index=data.index)
+
+    def values(self, data, cache) -> np.ndarray:
+        '''cached boolean array for this expression. the returned array must not be modified
+
+        cache: results for data, from MaskCache.for_data
+        '''
+        if self.key not in cache:
+            cache[self.key] = (self.refs, self._values(data, cache))
+
+        return cache[self.key][1]
+
+    @abstractmethod
+    def _values(self, data, cache) -> np.ndarray:
+        pass
+
+    def to_query(self) -> tuple:
+        '''DataFrame.eval form of the expression
+
+        returns: (query string, {name: value} for the @ references in the query)
+        '''
+        values = {}
+        return self._query(values), values
+
+    @abstractmethod
+    def _query(self, values:dict) -> str:
+        pass
+
+    def to_arrow_filter(self):
+        '''pyarrow dataset filter for the expression, so rows and row groups can be skipped while reading. unlike
+        pandas, missing values never match, including for !=
+
+        returns: pyarrow.compute.Expression
+        '''
+        import pyarrow.compute as pc
+
+        return self._arrow(pc)
+
+    @abstractmethod
+    def _arrow(self, pc):
+        pass
+
+    def __str__(self):
+        return self.str
+
+    def __repr__(self):
+        return f"MaskRule: {self.str}"
+
+class Comparison(Expression):
+    def __init__(self, column, operator, value):
+        '''column: column name, or a series to compare directly
+        operator: comparison operator as a string or function
+        value: value to compare to
+        '''
+        if isinstance(value, Iterable) and not isinstance(value, str):
+            raise ValueError("Iterable values can only be used with Range as the operator")
+
+        self.column = column
+        self.op_str, self.op_func = get_operator(operator)
+        self.value = value
+        self.str = f"{self.name} {self.op_str} {value}"
+        self.key = self._key(column, f"{self.name} {self.op_str} {value!r}") # repr keeps 18 and '18' apart
+        self.refs = () if isinstance(column, str) else (column,)
+
+    @staticmethod
+    def _key(column, description) -> str:
+        '''cache key for a comparison. series columns are identified by object. internal use only'''
+        return description if isinstance(column, str) else f"{id(column)}:{description}"
+
+    @property
+    def name(self):
+        return self.column if isinstance(self.column, str) else self.column.name
+
+    def column_values(self, data):
+        '''values of the column, as a numpy array where the dtype allows'''
+        series = data[self.column] if isinstance(self.column, str) else self.column.reindex(data.index)
+
+        return series.to_numpy() if isinstance(series.dtype, np.dtype) else series.array
+
+    def _compare(self, func, values, value):
+        result = func(values, value)
+        if hasattr(result, "to_numpy"): # nullable extension arrays, missing values do not match
+            result = result.to_numpy(dtype=bool, na_value=False)
+
+        return np.asarray(result, dtype=bool)
+
+    def _values(self, data, cache):
+        return self._compare(self.op_func, self.column_values(data), self.value)
+
+    def _reference(self, values, value):
+        if not isinstance(self.column, str):
+            raise ValueError(f"Rule on series {self.name} cannot be written as a query")
+
+        name = f"v{len(values)}"
+        values[name] = value
+
+        return f"`{self.column}`", f"@{name}"
+
+    def _query(self, values):
+        column, value = self._reference(values, self.value)
+        return f"({column} {self.op_str} {value})"
+
+    def _field(self, pc):
+        if not isinstance(self.column, str):
+            raise ValueError(f"Rule on series {self.name} cannot be used as a dataset filter")
+
+        return pc.field(self.column)
+
+    def _arrow(self, pc):
+        field = self._field(pc)
+        if self.op_func is op.ne: # NaN != value is True in memory, arrow would give null
+            return pc.is_null(field) | (field != self.value)
+
+        return self.op_func(field, self.value)
+
+class RangeComparison(Comparison):
+    def __init__(self, column, operator, start, end):
+        '''column: column name, or a series to compare directly
+        operator: range boundaries, one of "()", "[]", "[)", "(]" or the Range class
+        start: lower bound
+        end: upper bound
+        '''
+        self.column = column
+        self.op_str, self.range = get_operator(operator)
+        if not (isinstance(self.range, type) and issubclass(self.range, Range)):
+            raise ValueError("End values can only be used with Range as the operator")
+
+        self.start, self.end = start, end
+        self.str = self.range.format_range(self.name, start, end)
+        self.key = self._key(column, f"{self.name} {self.op_str} {start!r} {end!r}")
+        self.refs = () if isinstance(column, str) else (column,)
+
+    def _values(self, data, cache):
+        values = self.column_values(data)
+        mask = self._compare(self.range.left, values, self.start)
+        mask &= self._compare(self.range.right, values, self.end)
+
+        return mask
+
+    def _query(self, values):
+        column, start = self._reference(values, self.start)
+        _, end = self._reference(values, self.end)
+
+        return f"(({column} {OPERATOR_FUNCS[self.range.left]} {start}) & ({column} {OPERATOR_FUNCS[self.range.right]} {end}))"
+
+    def _arrow(self, pc):
+        field = self._field(pc)
+        return self.range.left(field, self.start) & self.range.right(field, self.end)
+
+class Combined(Expression):
+    def __init__(self, operator, *children):
+        '''operator: "&" or "|", as a string or function
+        children: expressions to combine
+        '''
+        self.op_str, self.op_func = get_operator(operator)
+        if self.op_func not in (op.and_, op.or_):
+            raise ValueError(f"Cannot combine rules with {self.op_str}")
+
+        self.children = children
+        self.str = f" {self.op_str} ".join(f"({child.str})" for child in children)
+        self.key = f"{self.op_str}[{','.join(child.key for child in children)}]"
+
+    def _values(self, data, cache):
+        ufunc = np.logical_and if self.op_func is op.and_ else np.logical_or
+        result = self.children[0].values(data, cache).copy()
+        for child in self.children[1:]:
+            ufunc(result, child.values(data, cache), out=result)
+
+        return result
+
+    def _query(self, values):
+        return "(" + f" {self.op_str} ".join(child._query(values) for child in self.children) + ")"
+
+    def _arrow(self, pc):
+        return reduce(self.op_func, (child._arrow(pc) for child in self.children))
+
+class Not(Expression):
+    def __init__(self, child):
+        '''child: expression to negate'''
+        self.child = child
+        self.str = f"!({child.str})"
+        self.key = f"![{child.key}]"
+
+    def _values(self, data, cache):
+        return ~self.child.values(data, cache)
+
+    def _query(self, values):
+        return f"~({self.child._query(values)})"
+
+    def _arrow(self, pc):
+        return ~pc.coalesce(self.child._arrow(pc), False) # a null child is a False one, so its negation matches
+
+def compile_rule(column, operator, value, end_value=None) -> Expression:
+    '''compile one rule tuple, as used in faux masks'''
+    if end_value is None:
+        return Comparison(column, operator, value)
+
+    return RangeComparison(column, operator, value, end_value)
+
+def _compile_block(operator, block) -> Expression:
+    '''compile one level of a faux mask. internal use only'''
+    if isinstance(block, dict):
+        children = [_compile_block(key, value) for key, value in block.items()]
+    else:
+        children = [compile_rule(*rule) for rule in block]
+
+    if operator == "!" or operator is op.not_:
+        if len(children) != 1:
+            raise ValueError("! negates a single rule or block")
+
+        return Not(children[0])
+
+    return children[0] if len(children) == 1 else Combined(operator, *children)
+
+def compile_mask(faux_mask:dict) -> Expression:
+    '''compile a faux mask into a reusable expression
+
+    faux_mask: nested dict of {operator: [rule tuples] or faux mask}, with a single operator at the top level. rule
+        tuples are (column name or series, operator, value) or (column name or series, range, start, end)
+
+    returns: expression, or None for an empty mask
+    '''
     if not faux_mask:
+        return None
+
+    if len(faux_mask) != 1:
+        raise ValueError("A mask must have a single top level operator")
+
+    (operator, block), = faux_mask.items()
+
+    return _compile_block(operator, block)
+
+class CompiledRule(Rule):
+    '''a compiled mask evaluated on a dataframe, with the same interface as Rule'''
+    def __init__(self, expression:Expression, data:pd.DataFrame, cache:MaskCache=None, engine="numpy"):
+        self.expression = expression
+        self.str = expression.str
+        self.mask = expression.evaluate(data, cache, engine)
+
+def build_mask(data:pd.DataFrame, faux_mask:dict, cache:MaskCache=None, engine="numpy"):
+    '''evaluate a faux mask on a dataframe
+
+    data: dataframe to mask
+    faux_mask: nested dict of rules, see compile_mask
+    cache: MaskCache of sub-expression results, shared between masks. may be reused across dataframes
+    engine: "numpy" or "eval", see Expression.evaluate
+
+    returns: CompiledRule with the boolean mask, or an all True series for an empty mask
+    '''
+    expression = compile_mask(faux_mask)
+    if expression is None:
         return pd.Series(True, index=data.index)
 
-    blocks = {}
-    current_level = -1
-    for thing, level in get_all_keys(faux_mask):
-        if isinstance(thing, str) or callable(thing):
-            current_lower_block = blocks[current_level]
-            if len(current_lower_block) == 1:
-                combined = current_lower_block[0]
-            else:
-                combined = CombinedRules(thing, *current_lower_block)
-
-            blocks[current_level] = []
-            current_block = blocks.setdefault(level, [])
-            current_block.append(combined)
-            current_level = level
-        else:
-            current_level = level
-            current_lower_block = blocks.setdefault(level, [])
-            for rule in thing:
-                series = rule[0]
-                if isinstance(series, str):
-                    series = data[series]
-
-                created_rule = Rule(series, *rule[1:])
-                current_lower_block.append(created_rule)
-
-    assert len(blocks[0]) == 1
-    return blocks[0][0]
+    return CompiledRule(expression, data, cache, engine)
@@ -1,13 +1,128 @@
+import hashlib
+import inspect
+import json
+import os
 import pickle
+from functools import partial, wraps
+from multiprocessing import Pool
+from pathlib import Path
 import matplotlib as mpl
 from matplotlib.figure import Figure
 import numpy as np
 import pandas as pd
 from datetime import datetime
-from matplotlib import pyplot as plt, patches as mpatches
+from matplotlib import pyplot as plt, patches as mpatches, cbook, image as mpimg
+
+source_fingerprint = hashlib.sha256(Path(__file__).read_bytes()).hexdigest() # plotting code in this module
+
+def hash_code(code, digest) -> None:
+    '''add a code object to a content hash, including its constants and nested functions, so that edits to literal
+    values such as colours and labels change the hash
+
+    code: code object
+    digest: hashlib object to update
+    '''
+    digest.update(code.co_code)
+    digest.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            hash_code(const, digest)
+        else:
+            digest.update(repr(const).encode())
+
+def hash_plot_inputs(value, digest) -> None:
+    '''add a plot argument to a content hash. arrays, pandas objects and uniform lists are hashed by value, and
+    functions by their code, defaults and closures
+
+    value: argument to hash
+    digest: hashlib object to update
+    '''
+    if isinstance(value, (pd.Series, pd.DataFrame, pd.Index)):
+        digest.update(type(value).__name__.encode())
+        digest.update(repr((getattr(value, "name", None), getattr(value, "columns", None))).encode())
+        digest.update(pd.util.hash_pandas_object(value, index=not isinstance(value, pd.Index)).to_numpy().tobytes())
+    elif isinstance(value, np.ndarray) and value.dtype != object:
+        digest.update(f"{value.dtype.str}{value.shape}".encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, dict):
+        digest.update(b"{")
+        for key in sorted(value, key=repr):
+            hash_plot_inputs(key, digest)
+            hash_plot_inputs(value[key], digest)
+        digest.update(b"}")
+    elif isinstance(value, (list, tuple, np.ndarray)):
+        try: # numbers and colour tuples are hashed as one array, not item by item
+            array = np.asarray(value)
+        except (ValueError, TypeError): # ragged
+            array = None
+
+        digest.update(f"{type(value).__name__}(".encode())
+        if array is not None and array.dtype.kind in "biufc":
+            hash_plot_inputs(array, digest)
+        else:
+            for item in value:
+                hash_plot_inputs(item, digest)
+        digest.update(b")")
+    elif isinstance(value, partial):
+        hash_plot_inputs((value.func, value.args, value.keywords), digest)
+    elif callable(value) and hasattr(value, "__code__"):
+        digest.update(f"{value.__module__}.{value.__qualname__}".encode())
+        hash_code(value.__code__, digest)
+        hash_plot_inputs(getattr(value, "__defaults__", None), digest)
+        for cell in getattr(value, "__closure__", None) or ():
+            try:
+                hash_plot_inputs(cell.cell_contents, digest)
+            except ValueError: # empty cell
+                digest.update(b"<empty>")
+    else: # objects without a stable repr hash differently every run, so they are always redrawn
+        digest.update(repr(value).encode())
+
+def cached_render(filename_arg:str):
+    '''skip drawing a plot when its saved image was drawn from identical inputs and options by the same plotting code.
+    drawn images are recorded in Plots.manifest_path. when drawing is skipped, the method returns a figure showing the
+    saved image
+
+    the key covers this module's source, any callbacks' code, the matplotlib version and Plots.render_version. bump
+    render_version, or set Plots.force_render, when drawing code outside these changes
+
+    filename_arg: name of the method argument holding the output filename
+    '''
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @wraps(func)
+        def wrapper(cls, *args, **kwargs):
+            bound = signature.bind(cls, *args, **kwargs)
+            bound.apply_defaults()
+            arguments = dict(bound.arguments)
+            arguments.pop("cls")
+            ext = arguments.get("ext", "png")
+            if not cls.use_render_cache or not arguments.get("save", True) or ext not in cls.cached_formats:
+                return func(cls, *args, **kwargs)
+
+            digest = hashlib.sha256()
+            hash_plot_inputs((cls.render_version, mpl.__version__, source_fingerprint, func.__qualname__, arguments), digest)
+            key = digest.hexdigest()
+            image_path = f"output/{arguments[filename_arg]}.{ext}"
+            if not cls.force_render and Path(image_path).is_file() and cls.read_manifest().get(image_path) == key:
+                return cls.figure_from_image(image_path)
+
+            fig = func(cls, *args, **kwargs)
+            cls.record_render(image_path, key)
+
+            return fig
+
+        return wrapper
+
+    return decorator
 
 class Plots:
     '''container for plotting functions'''
+    use_render_cache = True # skip plots whose saved image is up to date
+    force_render = False # redraw every plot, still recording it in the manifest
+    render_version = 1 # bump to redraw every cached plot
+    cached_formats = ("png", "jpg", "jpeg", "tif", "tiff") # formats a skipped plot can be loaded back from
+    manifest_path = Path("output/plot_manifest.jsonl")
     #https://clauswilke.com/dataviz/color-pitfalls.html
     default_color_scheme = ['#E69F00',
                             '#56B4E9',
@@ -18,9 +133,77 @@ class Plots:
                             "#CC79A7",
                             "#000000"]
 
+    @classmethod
+    def dispatch(cls, plot:str, queue=None, **kwargs):
+        '''draw a plot now, or hand it to a render queue if one is given
+
+        plot: name of the Plots method to call
+        queue: RenderQueue to submit the plot to. if None, the plot is drawn immediately
+        kwargs: keyword arguments for the plot method
+
+        returns: the figure if drawn immediately, otherwise None
+        '''
+        if queue is None:
+            return getattr(cls, plot)(**kwargs)
+
+        queue.submit(plot, **kwargs)
+
+    @classmethod
+    def read_manifest(cls) -> dict:
+        '''content hash of the inputs each image in the output folder was last drawn from
+
+        returns: {image path: hash}
+        '''
+        manifest = {}
+        if cls.manifest_path.is_file():
+            with open(cls.manifest_path, 'r') as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        manifest[entry["path"]] = entry["hash"]
+
+        return manifest
+
+    @classmethod
+    def record_render(cls, image_path, key) -> None:
+        '''add a drawn image to the manifest. entries are appended as single lines, so render workers can record
+        concurrently; later entries replace earlier ones'''
+        cls.manifest_path.parent.mkdir(parents=True, exist_ok=True)
+        line = json.dumps({"path": image_path, "hash": key}) + "\n"
+        fd = os.open(cls.manifest_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, line.encode())
+        finally:
+            os.close(fd)
+
+    @classmethod
+    def figure_from_image(cls, image_path, dpi=300) -> Figure:
+        '''figure showing a saved plot image at its original size, returned in place of a plot that was not redrawn
+
+        image_path: raster image file
+        dpi: resolution the image was saved with
+
+        returns: figure
+        '''
+        image = mpimg.imread(image_path)
+        fig = Figure(figsize=(image.shape[1] / dpi, image.shape[0] / dpi), dpi=dpi)
+        ax = fig.add_axes((0, 0, 1, 1))
+        ax.imshow(image)
+        ax.set_axis_off()
+
+        return fig
+
+    @classmethod
+    def compact_manifest(cls) -> None:
+        '''rewrite the manifest with only the latest entry for each image'''
+        manifest = cls.read_manifest()
+        with open(cls.manifest_path, 'w') as f:
+            for path, key in manifest.items():
+                f.write(json.dumps({"path": path, "hash": key}) + "\n")
+
     @classmethod
     def save_plt_fig(cls, fig, filename, bbox_extra_artists=None, ext="png",
-                     tight=True, include_timestamp=False, dpi=300, save_pickle=True) -> None:
+                     tight=True, include_timestamp=False, dpi=300, save_pickle=True, spec=None) -> None:
         '''Save a plot figure to file with timestamp.
 
         fig: figure to save
@@ -31,6 +214,8 @@ class Plots:
         include_timestamp: whether to include a timestamp as part of the filename. Suggested if multiple runs are to be compared.
         dpi: resolution with which to save the figure
         save_pickle: whether to save a pickle of the figure alongside the image file. Suggested if later editing of the figure is required.
+        spec: {"plot": Plots method name, "kwargs": arguments} that redraws the figure. if given, this is pickled with
+            the figure's axis limits instead of the figure itself
 
         '''
         current = datetime.now().strftime("%Y%m%dT%H%M%S")
@@ -45,15 +230,19 @@ class Plots:
             fig.savefig(output_path, format=ext, dpi=dpi)
 
         if save_pickle:
+            if spec is not None:
+                spec = {**spec, "axis": fig.gca().axis()}
+
             with open(pickle_path, 'wb') as f:
-                pickle.dump(fig, f)
+                pickle.dump(fig if spec is None else spec, f)
 
         plt.close(fig)
 
     @classmethod
+    @cached_render("output_path")
     def scatter_plot(cls, x, y, labels, output_path, title=None, lines=False,
                         legend=None, color=None, date_axis=False, partial_legend_colours=None,
-                        colbar=None, alpha=1, sort_lgd=True) -> None:
+                        colbar=None, alpha=1, sort_lgd=True, rasterize=False, bins=512) -> None:
         '''Create a scatter plot.
 
         x: data for the x axis
@@ -69,17 +258,24 @@ class Plots:
         colbar: if the legend should be a colour bar instead of class labels, pass in the data to be used
         alpha: alpha blending value for the plot
         sort_lgd: sort legend labels alphabetically
+        rasterize: draw points as a density image instead of individual markers. suggested for very large numbers of points.
+            markers are drawn if no point has finite coordinates
+        bins: number of image pixels along each axis when rasterizing
 
         '''
         fig = plt.figure(dpi=300)
         ax = fig.add_subplot(111)
         lgd = None
+        if isinstance(color, pd.Series):
+            color = color.values.tolist()
+
+        raster = cls._rasterize_points(x, y, color, alpha, bins) if rasterize and not lines else None
         if lines:
             artists = ax.plot(x, y, alpha=alpha)
+        elif raster is not None:
+            image, extent = raster
+            artists = ax.imshow(image, extent=extent, origin='lower', aspect='auto', interpolation='nearest')
         elif color is not None:
-            if isinstance(color, pd.Series):
-                color = color.values.tolist()
-
             artists = ax.scatter(x, y, c=color, marker='.', alpha=alpha)
         else:
             artists = ax.plot(x, y, linestyle="None", marker=".", alpha=alpha)
@@ -136,6 +332,52 @@ class Plots:
 
         return fig
 
+    @classmethod
+    def _rasterize_points(cls, x, y, color, alpha, bins) -> tuple:
+        '''bin points into a 2D histogram per colour and composite the layers into one RGBA image. internal use only
+
+        returns: (image of shape (bins, bins, 4), extent for imshow), or None if no point has finite coordinates
+        '''
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        rgba = mpl.colors.to_rgba_array(color if color is not None else "C0")
+        if len(rgba) == 1:
+            rgba = np.broadcast_to(rgba, (len(x), 4))
+
+        finite = np.isfinite(x) & np.isfinite(y)
+        if not finite.any():
+            return None
+
+        x, y, rgba = x[finite], y[finite], rgba[finite]
+        layer_colours, first_seen, codes = np.unique(rgba, axis=0, return_index=True, return_inverse=True)
+        order = np.argsort(first_seen) # layers are drawn in the order colours first appear, like scatter
+        layer_of_code = np.empty_like(order)
+        layer_of_code[order] = np.arange(len(order))
+        layers = layer_of_code[codes.ravel()]
+        layer_colours = layer_colours[order]
+
+        x_span = (x.max() - x.min()) or 1 # a single x or y value still gets a unit wide image
+        y_span = (y.max() - y.min()) or 1
+        extent = (x.min(), x.min() + x_span, y.min(), y.min() + y_span)
+        xi = np.clip(((x - extent[0]) / x_span * bins).astype(int), 0, bins - 1)
+        yi = np.clip(((y - extent[2]) / y_span * bins).astype(int), 0, bins - 1)
+        counts = np.bincount((layers * bins + yi) * bins + xi, minlength=len(layer_colours) * bins * bins)
+        counts = counts.reshape(len(layer_colours), bins, bins)
+
+        premultiplied = np.zeros((bins, bins, 4))
+        max_density = np.log1p(counts.max())
+        for layer, colour in zip(counts, layer_colours):
+            density = np.log1p(layer) / max_density
+            opacity = np.where(layer > 0, alpha * colour[3] * (0.3 + 0.7 * density), 0)[..., None]
+            premultiplied[..., :3] = colour[:3] * opacity + premultiplied[..., :3] * (1 - opacity)
+            premultiplied[..., 3:] = opacity + premultiplied[..., 3:] * (1 - opacity)
+
+        image = premultiplied.copy()
+        covered = image[..., 3] > 0
+        image[covered, :3] /= image[covered, 3:]
+
+        return image, extent
+
     @classmethod
     def _get_color_patches(cls, color, legend):
         '''create colour patches for the legend. internal use only
@@ -152,6 +394,7 @@ class Plots:
         return patches
 
     @classmethod
+    @cached_render("output_path")
     def multiline_scatter_plot(cls, x, ys, labels, line_labels, output_path, title=None,
                                colours=None, callback=None, legend_title=None) -> Figure:
         ''' create a multiline scatter plot.
@@ -186,7 +429,10 @@ class Plots:
 
         cls.save_plt_fig(fig, output_path, bbox_extra_artists=(lgd,), tight=True, save_pickle=False)
 
+        return fig
+
     @classmethod
+    @cached_render("filename")
     def categorical_bar_plot(cls, x, y, title, filename, axis_labels=None, y_limits=None) -> Figure:
         '''creates a categorical bar plot
 
@@ -217,8 +463,9 @@ class Plots:
         return fig
 
     @classmethod
+    @cached_render("filename")
     def basic_histogram(cls, data, filename, n_bins="unique_values",
-                        title=None, xlabel="Count", ylabel="Frequency") -> None:
+                        title=None, xlabel="Count", ylabel="Frequency", y_limits=None, save=True) -> Figure:
         '''creates and saves a histogram
 
         data: vector/series/list of values
@@ -227,6 +474,8 @@ class Plots:
         title: figure title
         xlabel: x axis label
         ylabel: y axis label
+        y_limits: tuple of (min, max) to set the y range
+        save: if False, the figure is returned without being saved
 
         '''
         if n_bins == "unique_values":
@@ -234,18 +483,27 @@ class Plots:
 
         fig = plt.figure()
         ax = fig.add_subplot(111)
-        ax.hist(data, n_bins, edgecolor='black', linewidth=1.2)
+        counts, edges, _ = ax.hist(data, n_bins, edgecolor='black', linewidth=1.2)
         ax.set_xlabel(xlabel)
         ax.set_ylabel(ylabel)
+        if y_limits is not None:
+            ax.set_ylim(y_limits)
+
         if title is not None:
             ttl = fig.suptitle(title)
 
-        cls.save_plt_fig(fig, filename)
+        if save:
+            spec = {"plot": "histogram_from_counts",
+                    "kwargs": {"counts": counts, "edges": edges, "filename": filename, "title": title, "xlabel": xlabel, "ylabel": ylabel}}
+            cls.save_plt_fig(fig, filename, spec=spec)
+
+        return fig
 
     @classmethod
     def create_boxplot_group(cls, data, labels, title, filename, axis_labels=None,
-                             show_outliers=True, figsize=(6.4, 4.8), ext="png") -> Figure:
-        '''creates and saves a group of boxplots
+                             show_outliers=True, figsize=(6.4, 4.8), ext="png", y_limits=None, save=True) -> Figure:
+        '''creates and saves a group of boxplots. the statistics are computed once and drawn by
+        boxplot_group_from_stats, which callers holding statistics already should use directly
 
         data: dataframe of the data to plot
         labels: Label for each boxplot. len(labels) match the number of columns in data
@@ -255,18 +513,86 @@ class Plots:
         show_outliers: if True, outliers will be shown as circles outside the boxplot quartiles
         figsize: figure dimensions (x, y) in inches
         ext: file type extension
+        y_limits: tuple of (min, max) to set the y range
+        save: if False, the figure is returned without being saved
+
+        '''
+        stats = cbook.boxplot_stats(data, labels=labels)
+        if not show_outliers: # not drawn, so not worth keeping in the saved spec
+            for box in stats:
+                box["fliers"] = box["fliers"][:0]
+
+        return cls.boxplot_group_from_stats(stats, title, filename, axis_labels=axis_labels, show_outliers=show_outliers,
+                                            figsize=figsize, ext=ext, y_limits=y_limits, save=save)
+
+    @classmethod
+    @cached_render("filename")
+    def histogram_from_counts(cls, counts, edges, filename, title=None, xlabel="Count", ylabel="Frequency",
+                              y_limits=None, save=True) -> Figure:
+        '''creates and saves a histogram from precomputed bin counts. matches basic_histogram for the same bins
+
+        counts: number of values in each bin
+        edges: bin edges, one longer than counts
+        filename: filename for the image
+        title: figure title
+        xlabel: x axis label
+        ylabel: y axis label
+        y_limits: tuple of (min, max) to set the y range
+        save: if False, the figure is returned without being saved
+
+        '''
+        fig = plt.figure()
+        ax = fig.add_subplot(111)
+        ax.hist(edges[:-1], bins=edges, weights=counts, edgecolor='black', linewidth=1.2)
+        ax.set_xlabel(xlabel)
+        ax.set_ylabel(ylabel)
+        if y_limits is not None:
+            ax.set_ylim(y_limits)
+
+        if title is not None:
+            ttl = fig.suptitle(title)
+
+        if save:
+            spec = {"plot": "histogram_from_counts",
+                    "kwargs": {"counts": counts, "edges": edges, "filename": filename, "title": title, "xlabel": xlabel, "ylabel": ylabel}}
+            cls.save_plt_fig(fig, filename, spec=spec)
+
+        return fig
+
+    @classmethod
+    @cached_render("filename")
+    def boxplot_group_from_stats(cls, stats, title, filename, axis_labels=None,
+                                 show_outliers=True, figsize=(6.4, 4.8), ext="png", y_limits=None, save=True) -> Figure:
+        '''creates and saves a group of boxplots from precomputed statistics. matches create_boxplot_group
+
+        stats: list of dicts with the keys used by matplotlib's bxp (med, q1, q3, whislo, whishi, fliers, label)
+        title: figure title
+        filename: for the saved figure
+        axis_labels: axis labels in (x, y) format
+        show_outliers: if True, outliers will be shown as circles outside the boxplot quartiles
+        figsize: figure dimensions (x, y) in inches
+        ext: file type extension
+        y_limits: tuple of (min, max) to set the y range
+        save: if False, the figure is returned without being saved
 
         '''
         fig = plt.figure(figsize=figsize)
         ax = fig.add_subplot(111)
-        ax.boxplot(data, showfliers=show_outliers)
+        ax.bxp(stats, showfliers=show_outliers)
         fig.suptitle(title)
-        ax.set_xticklabels(labels, rotation=45, ha='right')
+        ax.set_xticklabels([x["label"] for x in stats], rotation=45, ha='right')
         if axis_labels is not None:
             ax.set_xlabel(axis_labels[0])
             ax.set_ylabel(axis_labels[1])
 
-        cls.save_plt_fig(fig, filename, ext=ext, tight=True)
+        if y_limits is not None:
+            ax.set_ylim(y_limits)
+
+        if save:
+            spec = {"plot": "boxplot_group_from_stats",
+                    "kwargs": {"stats": stats, "title": title, "filename": filename, "axis_labels": axis_labels,
+                               "show_outliers": show_outliers, "figsize": figsize, "ext": ext}}
+            cls.save_plt_fig(fig, filename, ext=ext, tight=True, spec=spec)
 
         return fig
 
@@ -325,4 +651,62 @@ class Plots:
         normalised = temps.apply(lambda x: x / biggest)
         colours = normalised.apply(cls.blue_fader)
 
-        return colours
\ No newline at end of file
+        return colours
+
+def _use_agg_backend() -> None:
+    '''render worker initialiser. internal use only'''
+    mpl.use("Agg")
+
+def render_plot_spec(spec:dict) -> None:
+    '''draw and save a plot from a spec of {"plot": Plots method name, "kwargs": arguments}'''
+    getattr(Plots, spec["plot"])(**spec["kwargs"])
+
+class RenderQueue:
+    '''renders plot specs in a pool of worker processes, so analysis can continue while figures are written.
+
+    Arguments to the plot methods must be picklable; use functools.partial rather than lambdas for callbacks.
+    '''
+    def __init__(self, n_processes:int=4, render:bool=True):
+        '''n_processes: number of render workers. if 0, plots are drawn synchronously in this process
+        render: if False, submitted plots are discarded, for compute-only runs
+        '''
+        self.render = render
+        self.pool = Pool(n_processes, initializer=_use_agg_backend) if render and n_processes else None
+        self.pending = []
+
+    def submit(self, plot:str, **kwargs) -> None:
+        '''queue a plot for rendering
+
+        plot: name of the Plots method to call
+        kwargs: keyword arguments for the plot method
+        '''
+        if not self.render:
+            return
+
+        spec = {"plot": plot, "kwargs": kwargs}
+        if self.pool is None:
+            render_plot_spec(spec)
+        else:
+            self.pending.append(self.pool.apply_async(render_plot_spec, args=(spec,)))
+
+    def flush(self) -> None:
+        '''wait until every submitted plot has been written, re-raising the first render error'''
+        pending, self.pending = self.pending, []
+        for result in pending:
+            result.get()
+
+    def close(self) -> None:
+        '''flush the queue and shut down the workers'''
+        try:
+            self.flush()
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,108 @@
+'''mergeable streaming summaries for data that is too large to hold in memory'''
+import numpy as np
+
+class QuantileSketch:
+    '''KLL quantile sketch. Values are kept in levels of compactors, where an item on level h stands in for 2**h
+    original values. A full level is sorted and every other item is promoted, so memory stays below 3k items
+    regardless of how many values are added.
+
+    The normalised rank error of a quantile query is approximately 3.3/k with high probability, about 1.65% for the
+    default k=200. This is a probabilistic bound, not a hard one, and it still holds approximately after sketches
+    built on separate partitions are merged.
+    '''
+    rank_error = {50: 0.066, 100: 0.033, 200: 0.0165, 400: 0.0083} # approximate, high probability rank error for common k
+
+    def __init__(self, k:int=200, seed=None):
+        '''k: accuracy parameter, larger values are more accurate but use more memory
+        seed: seed for the random compaction offsets
+        '''
+        self.k = k
+        self.rng = np.random.default_rng(seed)
+        self.compactors = [np.empty(0)]
+        self.n = 0
+        self.total = 0.
+
+    def capacity(self, level:int) -> int:
+        '''number of items a level can hold before it is compacted. lower levels hold fewer items'''
+        depth = len(self.compactors) - level - 1
+        return max(int(np.ceil(self.k * (2 / 3) ** depth)), 2)
+
+    def update(self, values) -> "QuantileSketch":
+        '''add values to the sketch, ignoring NaNs
+
+        values: scalar or array of values
+        '''
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        if not values.size:
+            return self
+
+        self.compactors[0] = np.concatenate([self.compactors[0], values])
+        self.n += values.size
+        self.total += values.sum()
+        self._compress()
+
+        return self
+
+    def merge(self, other:"QuantileSketch") -> "QuantileSketch":
+        '''fold another sketch into this one
+
+        other: sketch built with the same k
+        '''
+        if other.k != self.k:
+            raise ValueError(f"Cannot merge sketches with different k ({self.k} and {other.k})")
+
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append(np.empty(0))
+
+        for level, items in enumerate(other.compactors):
+            self.compactors[level] = np.concatenate([self.compactors[level], items])
+
+        self.n += other.n
+        self.total += other.total
+        self._compress()
+
+        return self
+
+    def _compress(self):
+        '''compact every level that is over capacity, from the bottom up. internal use only'''
+        level = 0
+        while level < len(self.compactors):
+            items = self.compactors[level]
+            if len(items) >= self.capacity(level):
+                if level + 1 == len(self.compactors):
+                    self.compactors.append(np.empty(0))
+
+                items = np.sort(items)
+                n_compact = len(items) - len(items) % 2
+                promoted = items[self.rng.integers(2):n_compact:2]
+                self.compactors[level] = items[n_compact:]
+                self.compactors[level + 1] = np.concatenate([self.compactors[level + 1], promoted])
+
+            level += 1
+
+    def quantile(self, q):
+        '''estimate quantiles of all values added so far
+
+        q: quantile or list of quantiles in [0, 1]
+
+        returns: estimated value for each quantile, NaN if the sketch is empty
+        '''
+        q = np.asarray(q, dtype=float)
+        if not self.n:
+            return np.full(q.shape, np.nan)
+
+        items = np.concatenate(self.compactors)
+        weights = np.concatenate([np.full(len(x), 2. ** level) for level, x in enumerate(self.compactors)])
+        order = np.argsort(items)
+        cumulative = np.cumsum(weights[order])
+        positions = np.searchsorted(cumulative, q * cumulative[-1], side='left')
+
+        return items[order][np.clip(positions, 0, len(items) - 1)]
+
+    def mean(self) -> float:
+        '''exact mean of all values added so far'''
+        return self.total / self.n if self.n else np.nan
+
+    def __len__(self):
+        return sum(len(x) for x in self.compactors)
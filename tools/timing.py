@@ -0,0 +1,19 @@
+'''timing helpers shared by the benchmark scripts'''
+from time import perf_counter
+import numpy as np
+
+def time_call(func, *args, repeats=1, **kwargs):
+    '''run a function and return the fastest wall time with the last result
+
+    func: function to time
+    repeats: number of runs
+
+    returns: (seconds, result)
+    '''
+    best = np.inf
+    for _ in range(repeats):
+        start = perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, perf_counter() - start)
+
+    return best, result